@@ -28,9 +28,17 @@ import pickle
 import argparse
 from sklearn.preprocessing import StandardScaler
 from sklearn.ensemble import RandomForestClassifier
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'processing_data'))
+import storage
 
 OUTPUT_PATH = 'outputs/'
 
+# weight of the SQ confidence for each level the SQ prediction was made at, coarser levels are less similar
+LEVEL_WEIGHTS = {'postcode':1, 'lsoa_code':0.9, 'msoa_code':0.8}
+
 def loading_data_from_files():
 	'''function for loading  the seperate dataframes after predictions have been made.
 
@@ -39,8 +47,8 @@ def loading_data_from_files():
 			sim (pd.dataframe): df of homes that have a similarity quantification prediction
 	'''
 
-	no_sim = pd.read_csv(OUTPUT_PATH+'epc/all_predictions_homes_without_sim.csv')
-	sim = pd.read_csv(OUTPUT_PATH+'epc/all_predictions_homes_with_sim.csv')
+	no_sim = storage.read_table(OUTPUT_PATH+'epc/all_predictions_homes_without_sim')
+	sim = storage.read_table(OUTPUT_PATH+'epc/all_predictions_homes_with_sim')
 
 	return no_sim, sim 
 
@@ -55,6 +63,9 @@ def comparing_results(df):
 			df (pd.dataframe): df with single prediction and confidence levels'''
 
 
+	if 'SQ_level' in df:
+		df['SQ_confidence'] = df['SQ_confidence'] * df['SQ_level'].map(LEVEL_WEIGHTS).fillna(1)		# weighting the SQ confidence by the level of the SQ prediction
+
 	# describing conditions that will be used for assigning the additional power load for each type of house
 	conditions = [(df['predicted']==0), (df['SQ_current-energy-rating'].isnull()),
 					(df['SQ_current-energy-rating'] == df['RF_current-energy-rating']), 
@@ -98,7 +109,7 @@ def main(df):
 
 	df.reset_index(inplace=True, drop=True)
 
-	df.to_csv(OUTPUT_PATH+'combined_epc_ratings.csv', index=False)
+	storage.write_table(df, OUTPUT_PATH+'combined_epc_ratings')
 
 	return df
 
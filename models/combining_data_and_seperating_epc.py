@@ -16,9 +16,15 @@ import numpy as np
 import glob
 import pickle
 import argparse
+import os
+import sys
 from sklearn.preprocessing import StandardScaler
 from sklearn.ensemble import RandomForestClassifier
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'processing_data'))
+from proxy_schema import read_proxies
+import storage
+
 
 DATA_PATH = 'data/processed/'		# path to the data from the project directory
 OUTPUT_PATH = 'outputs/'
@@ -37,10 +43,13 @@ def loading_proxies():
 	'''Function to load and combine the seperate proxy files into
 		one dataframe. 
 
+		Read with the compact proxy schema (int32 codes, float32 attributes, uint8 one hot columns).
+
 		RETURNS:
 			tiles_df (pd.dataframe): df containing the data for all the homes in the target area (west midlands)'''
 
-	tiles_df = pd.read_csv(DATA_PATH+'merged_and_encoded_proxies.csv')
+	tiles_df = read_proxies(DATA_PATH+'merged_and_encoded_proxies')
+	print(f'Loaded proxies using {tiles_df.memory_usage(deep=True).sum() / 1e6:.1f} MB')
 	return tiles_df
 
 
@@ -50,7 +59,7 @@ def loading_epc():
 		RETURNS:
 			epc_df (pd.dataframe): df containing the epc data'''
 
-	epc_df = pd.read_csv(DATA_PATH+'cleaned_epc_data.csv')
+	epc_df = storage.read_table(DATA_PATH+'cleaned_epc_data')
 
 	return epc_df
 
@@ -99,8 +108,8 @@ def main():
 	proxies, epc = merging_epc_and_proxies(epc_df, tiles_df)
 
 	# saving the data frames 
-	proxies.to_csv(DATA_PATH+'homes_with_proxies.csv', index=False)
-	epc.to_csv(DATA_PATH+'homes_with_epc_ratings.csv', index=False)
+	storage.write_table(proxies, DATA_PATH+'homes_with_proxies')
+	storage.write_table(epc, DATA_PATH+'homes_with_epc_ratings')
 
 	return proxies, epc
 
@@ -19,6 +19,11 @@ import geopandas.tools
 from shapely.geometry import Point
 from shapely import wkt
 import rtree
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'processing_data'))
+import storage
 
 
 '''CONFIG dict storing global information. 
@@ -28,13 +33,14 @@ import rtree
 
 DATA_PATH = 'data/processed/'
 OUTPUT_PATH = 'outputs/'
+EPC_LOAD_COLUMNS = ['calculatedAreaValue', 'current-energy-rating', 'mainheat-description', 'energy-consumption-current', 'heating-cost-current']	# EPC columns used for calculating the additional loads
 
 CONFIG = {
 		'random_int': 123,
 		'features_to_keep':['uprn', 'postcode', 'calculatedAreaValue', 'RelHMax', 'LATITUDE', 'LONGITUDE', 'lsoa_code',
 							'msoa_code', 'prop_households_fuel_poor', 'total_consumption', 'mean_counsumption', 
 						  	'median_consumption', 'constituency', 'current-energy-rating',
-						   'current-energy-efficiency', 'SQ_current-energy-rating', 'SQ_confidence', 
+						   'current-energy-efficiency', 'SQ_current-energy-rating', 'SQ_confidence', 'SQ_level', 
 						   'RF_current-energy-rating', 'RF_confidence', 'confidence', 'confidence_within_one_rating',
 						   'mainheat-description', 'additional_load', 'additional_peak_load', 'predicted']}
 
@@ -185,10 +191,11 @@ def main(full_dataset=None, epc_df=None):
 	'''
 
 	if full_dataset.empty:
-		full_dataset = pd.read_csv(OUTPUT_PATH+'combined_epc_ratings.csv') 			# loading the full dataset
+		columns = [col for col in CONFIG['features_to_keep'] if col not in ['additional_load', 'additional_peak_load']]
+		full_dataset = storage.read_table(OUTPUT_PATH+'combined_epc_ratings', columns=columns) 			# loading the columns kept in the output
 
 	if epc_df.empty:
-		epc_df = pd.read_csv(DATA_PATH+'cleaned_epc_data.csv') 			# loading the EPC dataset
+		epc_df = storage.read_table(DATA_PATH+'cleaned_epc_data', columns=EPC_LOAD_COLUMNS) 			# loading the EPC columns used for the loads
 
 	total_load, peak_load = calculating_additional_load(full_dataset, epc_df)
 
@@ -203,7 +210,7 @@ def main(full_dataset=None, epc_df=None):
 
 	full_dataset = full_dataset[CONFIG['features_to_keep']] 					# keeping only the realevent features
 
-	full_dataset.to_csv(OUTPUT_PATH+'full_dataset_outputs.csv', index=False)		# saving the dataset
+	storage.write_table(full_dataset, OUTPUT_PATH+'full_dataset_outputs')		# saving the dataset
 
 	full_dataset['geometry'] = full_dataset.apply(lambda row: Point(row['LONGITUDE'], row['LATITUDE']), axis=1)
 
@@ -65,7 +65,7 @@ CONFIG = {
 						  	'median_consumption', 'local-authority_E07000192',
 							'local-authority_E08000025', 'local-authority_E08000027', 'local-authority_E08000028',
 							'local-authority_E08000030', 'local-authority_E08000031', 'constituency', 'current-energy-rating',
-						   'current-energy-efficiency', 'SQ_current-energy-rating', 'SQ_confidence', 'RF_current-energy-rating',
+						   'current-energy-efficiency', 'SQ_current-energy-rating', 'SQ_confidence', 'SQ_level', 'RF_current-energy-rating',
 						   'RF_confidence', 'confidence', 'confidence_within_one_rating', 'predicted', 'current-energy-rating_combo',
 						   'mainheat-description', 'additional_load', 'additional_peak_load']}
 							
@@ -0,0 +1,163 @@
+######################################################################################
+#
+#	model/model_registry.py
+#
+#	Saving and loading the trained models. Models are stored with joblib next to a
+#	json file recording the features they were trained on (order and dtypes) and a
+#	hash of the training data. Loading a model for predicting checks the input
+#	features against the recorded ones, so a model is never used with columns in
+#	the wrong order or of a different kind (integer, float, ...).
+#
+#
+######################################################################################
+
+import pandas as pd
+import numpy as np
+import sklearn
+import joblib
+import hashlib
+import pickle
+import json
+import time
+import os
+
+
+def training_hash(X, y=None):
+	'''Function hashing the training data, content only (index ignored).
+
+		INPUTS:
+			X (pd.DataFrame): training input data
+			y (pd.Series): training target data
+
+		RETURNS:
+			(str): sha256 of the training data
+	'''
+
+	sha256 = hashlib.sha256()
+	sha256.update(pd.util.hash_pandas_object(X, index=False).to_numpy().tobytes())
+	if y is not None:
+		sha256.update(pd.util.hash_pandas_object(y, index=False).to_numpy().tobytes())
+
+	return sha256.hexdigest()
+
+
+def feature_schema(X):
+	'''Function returning the feature order and dtypes of the input data.
+
+		RETURNS:
+			(dict): 'features' list and 'dtypes' dict
+	'''
+
+	return {'features': list(X.columns), 'dtypes': {col: str(dtype) for col, dtype in X.dtypes.items()}}
+
+
+def dtype_kind(dtype):
+	'''Function returning the kind of a dtype, so widths and nullable variants (e.g. int32, Int32 and
+		int64) compare equal.
+
+		RETURNS:
+			(str): 'bool', 'integer', 'float', or the dtype name for other dtypes
+	'''
+
+	dtype = pd.api.types.pandas_dtype(dtype)
+	if pd.api.types.is_bool_dtype(dtype):
+		return 'bool'
+	if pd.api.types.is_integer_dtype(dtype):
+		return 'integer'
+	if pd.api.types.is_float_dtype(dtype):
+		return 'float'
+
+	return str(dtype)
+
+
+def check_schema(metadata, X):
+	'''Function checking that the input data has the features, in the same order and with the same
+		kinds of dtypes, as the data the model was trained on. Integer columns loaded as nullable
+		Int32/Int64 in one load and int32 in another are the same kind.
+
+		INPUTS:
+			metadata (dict): metadata saved with the model
+			X (pd.DataFrame): input data for predicting
+
+		RAISES:
+			ValueError: if the feature names or order, or the kinds of dtypes differ
+	'''
+
+	schema = feature_schema(X)
+	if schema['features'] != metadata['features']:
+		missing = [col for col in metadata['features'] if col not in schema['features']]
+		extra = [col for col in schema['features'] if col not in metadata['features']]
+		raise ValueError(f"Features don't match the model's, missing {missing}, unexpected {extra} (order must also match)")
+
+	wrong = {col: (dtype, metadata['dtypes'][col]) for col, dtype in schema['dtypes'].items() if dtype_kind(dtype) != dtype_kind(metadata['dtypes'][col])}
+	if wrong:
+		raise ValueError(f"Feature dtypes don't match the model's, (input, trained) dtypes: {wrong}")
+
+
+def save_model(model, path, X, y=None, compress=3):
+	'''Function saving a trained model with its feature schema and training data hash.
+
+		INPUTS:
+			model: trained model
+			path (str): path of the model, without extension
+			X (pd.DataFrame): input data the model was trained on
+			y (pd.Series): target data the model was trained on
+			compress (int): joblib compression level 0-9. Models saved with 0 can be loaded memory-mapped.
+
+		RETURNS:
+			(str): path to the saved model
+	'''
+
+	if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+		os.makedirs(os.path.dirname(path))
+
+	start = time.time()
+	joblib.dump(model, path+'.joblib.tmp', compress=compress)
+	os.replace(path+'.joblib.tmp', path+'.joblib')
+
+	metadata = feature_schema(X)
+	metadata.update({'model': type(model).__name__, 'sklearn_version': sklearn.__version__, 'compress': compress,
+					'training_rows': len(X), 'training_hash': training_hash(X, y)})
+	with open(path+'.json.tmp', 'w') as f:
+		json.dump(metadata, f, indent=2)
+	os.replace(path+'.json.tmp', path+'.json')
+
+	print(f"Saved {type(model).__name__} ({os.path.getsize(path+'.joblib')/1e6:.1f} MB) in {time.time()-start:.1f}s")
+
+	return path+'.joblib'
+
+
+def load_model(path, X=None, mmap_mode=None):
+	'''Function loading a saved model, checking the input data against its feature schema. Models
+		pickled as .h5 before the registry are still loaded, without a schema to check against.
+
+		INPUTS:
+			path (str): path of the model, without extension
+			X (pd.DataFrame): input data for predicting, checked against the schema if given
+			mmap_mode (str): 'r' to memory-map the tree arrays instead of reading them, only for
+						models saved with compress=0
+
+		RETURNS:
+			model: trained model
+	'''
+
+	if not os.path.exists(path+'.joblib') and os.path.exists(path+'.h5'):
+		print(f"Loading {path}.h5 without a feature schema, refit to save it with one....")
+		with open(path+'.h5', 'rb') as f:
+			return pickle.load(f)
+
+	with open(path+'.json', 'r') as f:
+		metadata = json.load(f)
+
+	if X is not None:
+		check_schema(metadata, X)
+
+	if mmap_mode and metadata['compress']:
+		print('Compressed models cannot be memory-mapped, loading into memory....')
+		mmap_mode = None
+
+	start = time.time()
+	model = joblib.load(path+'.joblib', mmap_mode=mmap_mode)
+	print(f"Loaded {metadata['model']} in {time.time()-start:.1f}s")
+
+	return model
@@ -15,11 +15,17 @@
 import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
-import pickle
 import argparse
 from sklearn.preprocessing import StandardScaler
 from sklearn.ensemble import RandomForestClassifier, RandomForestRegressor
 import gc
+import time
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'processing_data'))
+import storage
+import model_registry
 
 
 DATA_PATH = 'data/processed/'		# path to the data from the project directory
@@ -30,6 +36,8 @@ MODEL_PATH = 'models/trained_models/'
 	random_int: integer setting the reandom seed for reproducibility.
 	input_features: list of features to be segmented from the larger training and testing datasets
 					for input to the models.
+	batch_size: number of rows predicted at once, bounds the memory used for predicting.
+	n_jobs: number of threads the trees are evaluated on while predicting, -1 for all cores.
 '''
 CONFIG = {
 		'random_int': 123,
@@ -37,13 +45,15 @@ CONFIG = {
 							'msoa_code', 'prop_households_fuel_poor', 'total_consumption', 'mean_counsumption', 
 						  	'median_consumption', 'local-authority_E07000192',
 							'local-authority_E08000025', 'local-authority_E08000027', 'local-authority_E08000028',
-							'local-authority_E08000030', 'local-authority_E08000031', 'constituency']}
+							'local-authority_E08000030', 'local-authority_E08000031', 'constituency'],
+		'batch_size': 100000,
+		'n_jobs': -1}
 
 
 # setting random seed for reporducibility. SK learn uses numpy random seed.
 np.random.seed(CONFIG['random_int'])
 
-def loading_training_data(target, train_df=None):
+def loading_training_data(target, train_df=None, columns=None):
 
 	''' Function for loading the pre-seperated training data. The target var is then 
 		seperated and everything not in the input_features list is dropped.
@@ -51,6 +61,7 @@ def loading_training_data(target, train_df=None):
 		INPUTS: 
 		target (str): the target varaible. Either 'mainheat-description for elec/non-elec prediction, or 
 						'current-energy-rating' for the epc rating.
+		columns (list): columns to load from the saved file. All columns are loaded if None
 
 		RETURNS:
 		X_train (pd.DataFrame): dataframe ready to be put into the model for fitting.
@@ -58,7 +69,7 @@ def loading_training_data(target, train_df=None):
 		train_df (pd.DataFrame): original dataframe that will be used for producing final output.
 	'''
 	if train_df.empty:
-		train_df = pd.read_csv(DATA_PATH+'homes_with_epc_ratings.csv')	# loading the training dataframe from saved file
+		train_df = storage.read_table(DATA_PATH+'homes_with_epc_ratings', columns=columns)	# loading the training dataframe from saved file
 	
 	y_train = train_df[target]									# extracting the target varaible
 
@@ -81,10 +92,10 @@ def loading_testing_data(test_df=None, file_path=None):
 	'''
 	if test_df.empty:
 		if file_path:
-			test_df = pd.read_csv(file_path)	# loading the testing dataframe
+			test_df = storage.read_table(file_path)	# loading the testing dataframe
 
 		if file_path==None:
-			test_df = pd.read_csv(DATA_PATH+'homes_with_proxies.csv')	# loading the testing dataframe
+			test_df = storage.read_table(DATA_PATH+'homes_with_proxies')	# loading the testing dataframe
 
 
 	X_test = test_df[CONFIG['input_features']]					# dropping everything not in the 'input_features'
@@ -110,6 +121,41 @@ def define_model(n_estimators=1000, criterion='entropy'):
 	return model
 
 
+def batch_predict(model, X_test, method, path, batch_size=CONFIG['batch_size'], n_jobs=CONFIG['n_jobs']):
+	''' 
+		Predicting on the testing data in chunks of rows, one chunk after another. Within a chunk
+		the model evaluates its trees on n_jobs threads. Each chunk's predictions are written to a
+		Parquet file as soon as they are made. Chunking bounds the memory of the per-tree intermediate
+		results, but the predictions of all chunks are also kept and returned, so the returned
+		predictions still grow with the number of homes.
+
+		INPUTS: 
+		model: fitted model
+		X_test (pd.DataFrame): prepared testing input data
+		method (str): 'predict_proba' or 'predict'
+		path (str): path of the file the predictions are written to
+		batch_size (int): number of rows predicted at once
+		n_jobs (int): number of threads used by the model, -1 for all cores
+
+		RETURNS:
+		y_pred (pd.DataFrame): predicted values from the model.
+	'''
+	model.set_params(n_jobs=n_jobs)
+	predict = getattr(model, method)
+
+	start = time.time()
+	y_pred = []
+	with storage.TableWriter(path) as writer:
+		for first in range(0, len(X_test), batch_size):
+			chunk = pd.DataFrame(predict(X_test.iloc[first:first+batch_size]))		# predicting the output values of the chunk
+			writer.write(chunk.rename(columns=str))
+			y_pred.append(chunk)
+
+	print(f'Predicted {len(X_test)} rows in {len(y_pred)} chunks in {time.time()-start:.1f}s')
+
+	return pd.concat(y_pred, ignore_index=True) if y_pred else pd.DataFrame()
+
+
 def fitting_and_predicting(X_train, X_test, y_train, predicting, to_fit, file_name):
 	''' 
 		Function that does the fitting of the defined model on the 
@@ -132,26 +178,24 @@ def fitting_and_predicting(X_train, X_test, y_train, predicting, to_fit, file_na
 		model = define_model()		# getting the model
 		print('Fitting the classifier....')
 		model.fit(X_train, y_train)		# fitting the model
+
+		# saving the model with the features it was trained on
+		print('Saving the model....')
+		model_registry.save_model(model, MODEL_PATH+'{0}/{1}'.format(predicting, file_name), X_train, y_train)
 		del X_train, y_train
 		gc.collect()
 		
-		# saving the model
-		print('Saving the model....')
-		with open(MODEL_PATH+'{0}/{1}.h5'.format(predicting, file_name), 'wb') as m:
-			pickle.dump(multiclass_model, m)
-		
 
 	if to_fit==False:
-		with open(MODEL_PATH+'{0}/{1}.h5'.format(predicting, file_name), 'rb') as f:
-			model = pickle.load(f)
+		model = model_registry.load_model(MODEL_PATH+'{0}/{1}'.format(predicting, file_name), X_test)	# refuses inputs that don't match the trained features
 	print('Predicting....')
-	y_pred = model.predict_proba(X_test)		# predicting the output values
+	y_pred = batch_predict(model, X_test, 'predict_proba', OUTPUT_PATH+'{0}/{1}_predictions'.format(predicting, file_name))		# predicting the output values
 	
 	del X_test
 	gc.collect()
 
 
-	return pd.DataFrame(y_pred), model
+	return y_pred, model
 
 
 
@@ -179,23 +223,21 @@ def fitting_and_predicting_regression(X_train, X_test, y_train, predicting, to_f
 		print('fitting regressor....')
 		model.fit(X_train, y_train)		# fitting the model
 
-		# saving the model
-		with open(MODEL_PATH+'{0}/{1}.h5'.format(predicting, file_name), 'wb') as r:
-			pickle.dump(regression_model, r)
+		# saving the model with the features it was trained on
+		model_registry.save_model(model, MODEL_PATH+'{0}/{1}'.format(predicting, file_name), X_train, y_train)
 		
 		
 
 	if to_fit==False:
-		with open(MODEL_PATH+'{0}/{1}.h5'.format(predicting, file_name), 'rb') as f:
-			model = pickle.load(f)
+		model = model_registry.load_model(MODEL_PATH+'{0}/{1}'.format(predicting, file_name), X_test)	# refuses inputs that don't match the trained features
 	
 	print('predicting regressor....')
-	y_pred = model.predict(X_test)		# predicting the output values
+	y_pred = batch_predict(model, X_test, 'predict', OUTPUT_PATH+'{0}/{1}_predictions'.format(predicting, file_name))		# predicting the output values
 	del X_test
 	gc.collect()
 
 
-	return pd.DataFrame(y_pred), model
+	return y_pred, model
 
 
 
@@ -317,7 +359,9 @@ def main(train_df, test_df, target, predicting, saved_file_name, to_fit=True, fi
 		X_train, y_train = pd.DataFrame(), pd.Series()
 
 	else:
-		X_train, y_train, train_df = loading_training_data(target=target, train_df=train_df)		# loading the pre-seperated training data
+		# the epc output only uses the test homes, so only the model inputs and targets of the training homes are loaded
+		columns = CONFIG['input_features'] + [target, 'current-energy-efficiency'] if predicting == 'epc' else None
+		X_train, y_train, train_df = loading_training_data(target=target, train_df=train_df, columns=columns)		# loading the pre-seperated training data
 		____, y_train_eff, ___ = loading_training_data(target='current-energy-efficiency', train_df=train_df)		# loading the pre-seperated training data
 		X_test, test_df = loading_testing_data(test_df=test_df, file_path=file_path)			# loading the pre-seperated testing data
 	
@@ -348,7 +392,7 @@ def main(train_df, test_df, target, predicting, saved_file_name, to_fit=True, fi
 		output_df = attaching_training_data_to_mainheat(train_df, test_df, y_pred)		# creating the final output file
 
 
-	output_df.to_csv(OUTPUT_PATH+'{0}/{1}.csv'.format(predicting, saved_file_name), index=False)	# saving the file.	
+	storage.write_table(output_df, OUTPUT_PATH+'{0}/{1}'.format(predicting, saved_file_name))	# saving the file.	
 	
 	
 
@@ -18,6 +18,11 @@ import pickle
 from tqdm import tqdm
 import inspect
 import gc
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'processing_data'))
+import storage
 
 DATA_PATH = '../data/processed/'		# data path
 OUTPUT_PATH = 'outputs/'
@@ -29,6 +34,8 @@ OUTPUT_PATH = 'outputs/'
 CONFIG = {
 		'random_int': 123}
 
+LEVELS = ['postcode', 'lsoa_code', 'msoa_code']		# levels searched for similar homes, finest first
+
 
 def loading_epc_data():
 
@@ -39,7 +46,7 @@ def loading_epc_data():
 				homes in the epc database.
 	'''
 
-	epc_df = pd.read_csv(DATA_PATH+'homes_with_epc_ratings.csv')
+	epc_df = storage.read_table(DATA_PATH+'homes_with_epc_ratings')
 
 	return epc_df
 
@@ -51,12 +58,170 @@ def loading_all_homes_data():
 		epc_df (pd.DataFrame): dataframe contianing data from the 
 				homes in the epc database.
 	'''
-	all_df = pd.read_csv(DATA_PATH+'homes_with_proxies.csv')
+	all_df = storage.read_table(DATA_PATH+'homes_with_proxies')
 
 	return all_df
 
 
-def similar_homes(all_df, epc_df, level='postcode', precision=2):
+class AreaIndex():
+	'''Sorted index of the EPC homes' footprint areas within each code of a level (e.g. postcode). Answers
+		"all EPC homes in the same code within tolerance m2 of this footprint" for many homes at once with
+		np.searchsorted, so matching at another precision or tolerance is a query instead of a rerun.
+
+		EPC homes are sorted by (code, area). For a given precision, each EPC home gets an integer key
+		code*(n+1) + rank of its rounded area among the n distinct rounded areas, so the homes matching
+		a footprint are one contiguous run of keys. Rounding keeps the sort order, so the keys of each
+		precision are computed once from the same sorted arrays.
+
+		INPUTS:
+			epc_df (pd.DataFrame): dataframe that contains data from properties in the EPC database.
+			level (str): area in which comparisons of area will be made between homes.
+	'''
+
+	def __init__(self, epc_df, level='postcode'):
+
+		EPC = epc_df[[level, 'calculatedAreaValue', 'current-energy-rating', 'uprn']].dropna()		# homes without an area, rating or uprn can't be matched
+
+		self.level = level
+		self.codes = pd.Index(EPC[level].unique())
+		code = self.codes.get_indexer(EPC[level])
+		area = EPC['calculatedAreaValue'].to_numpy()
+		order = np.lexsort((area, code))
+
+		self.code = code[order]
+		self.area = area[order]
+		self.ratings = EPC['current-energy-rating'].to_numpy()[order]
+		self.precisions = {}										# keys of each queried precision
+
+
+	def keys(self, precision):
+
+		'''Function returning the rounded areas, distinct rounded areas and keys of the EPC homes at a precision,
+			computing them on the first query.
+
+			INPUTS:
+				precision (int): areas are rounded to this precision, None to use them as they are.
+
+			RETURNS:
+				rounded (np.array): rounded area of each EPC home in index order
+				values (np.array): sorted distinct rounded areas
+				keys (np.array): sorted (code, area rank) key of each EPC home
+		'''
+
+		if precision not in self.precisions:
+			rounded = self.area if precision is None else np.round(self.area, precision)
+			values = np.unique(rounded)
+			keys = self.code*(len(values)+1) + np.searchsorted(values, rounded)
+			self.precisions[precision] = (rounded, values, keys)
+
+		return self.precisions[precision]
+
+
+	def query(self, homes, precision=2, tolerance=0, keys=None):
+
+		'''Function finding every EPC home in the same code within tolerance of the rounded area of each home.
+			Matches are weighted by their distance, from 1 for the same area down to 0.5 at the tolerance.
+
+			INPUTS:
+				homes (pd.DataFrame): homes with the level, 'uprn' and 'calculatedAreaValue' columns and no missing values.
+				precision (int): areas are rounded to this precision before comparing.
+				tolerance (float): largest difference in m2 between the rounded areas of matching homes.
+				keys (list): columns of homes identifying a home, defaults to [level, 'uprn'].
+
+			RETURNS:
+				matches (pd.DataFrame): one row per matching EPC home with the keys, 'area',
+							'current-energy-rating', 'distance' and 'weight'
+		'''
+
+		rounded, values, index_keys = self.keys(precision)
+
+		code = self.codes.get_indexer(homes[self.level])
+		area = homes['calculatedAreaValue'].to_numpy()
+		area = area if precision is None else np.round(area, precision)
+		area64 = area.astype(np.float64)
+
+		# first and last distinct area within tolerance of each home, then the run of keys between them
+		lo = np.searchsorted(values, area64 - tolerance, side='left')
+		hi = np.searchsorted(values, area64 + tolerance, side='right')
+		start = np.searchsorted(index_keys, code*(len(values)+1) + lo, side='left')
+		end = np.searchsorted(index_keys, code*(len(values)+1) + hi, side='left')
+		n = np.where(code>=0, end-start, 0)							# homes in a code without EPC homes have no matches
+
+		home = np.repeat(np.arange(len(homes)), n)
+		position = np.repeat(start, n) + np.arange(n.sum()) - np.repeat(np.cumsum(n)-n, n)		# positions of the EPC homes in each run
+
+		distance = np.abs(rounded[position].astype(np.float64) - area64[home])
+		weight = 1 - distance/(2*tolerance) if tolerance > 0 else np.ones(len(home))
+
+		keys = [self.level, 'uprn'] if keys is None else keys
+		matches = homes[keys].iloc[home].reset_index(drop=True)
+		matches['area'] = area[home]
+		matches['current-energy-rating'] = self.ratings[position]
+		matches['distance'] = distance
+		matches['weight'] = weight
+
+		return matches
+
+
+def rating_modes(matches, keys):
+
+	'''Function reducing the matching EPC homes of each home to a single rating. The rating is the most common
+		rating of the matches, counting each match by its weight (ties go to the lowest letter, as pd.Series.mode).
+		The confidence tier depends on the weighted share of matches with that rating and on how many there are,
+		and is scaled by the mean weight of those matches.
+
+		INPUTS:
+			matches (pd.DataFrame): one row per matching EPC home with the keys, 'area', 'current-energy-rating'
+						and optionally 'weight' (1 if missing).
+			keys (list): columns identifying a home, e.g. [level, 'uprn'].
+
+		RETURNS:
+			predictions (pd.DataFrame): one row per home with the keys, 'area', 'SQ_current-energy-rating' and 'SQ_confidence'
+	'''
+
+	if 'weight' not in matches:
+		matches = matches.assign(weight=1.0)
+
+	counts = matches.groupby(keys+['current-energy-rating'])['weight'].agg(['size', 'sum', 'mean'])		# number and weight of matches with each rating
+	counts = counts.rename(columns={'size':'highest_mode', 'sum':'score', 'mean':'mean_weight'}).reset_index()
+	counts = counts.sort_values(keys+['score', 'current-energy-rating'], ascending=[True]*len(keys)+[False, True])
+	predictions = counts.drop_duplicates(keys).set_index(keys)			# most common rating of each home
+	predictions['total'] = matches.groupby(keys)['weight'].sum()
+
+	areas = matches.groupby(keys+['area']).size().rename('count').reset_index()		# taking the mode of the area just for convienience
+	areas = areas.sort_values(keys+['count', 'area'], ascending=[True]*len(keys)+[False, True])
+	predictions['area'] = areas.drop_duplicates(keys).set_index(keys)['area']
+
+	perc = predictions['score']/predictions['total']			# the percentage of ratings that correspond to the most common rating
+
+	''' Confidence tiers based on the number of home with the same area have the same rating, and how many
+		homes have that area. Ratings drop one tier if there is only one home with the same area.
+	'''
+	conditions = [(perc>0.66) & (predictions['highest_mode']>1), perc>0.66, (perc>0.33) & (predictions['highest_mode']>1)]
+	predictions['SQ_confidence'] = np.select(conditions, [0.8, 0.5, 0.5], default=0.3) * predictions['mean_weight']
+
+	predictions = predictions.rename(columns={'current-energy-rating':'SQ_current-energy-rating'}).reset_index()
+
+	return predictions[keys+['area', 'SQ_current-energy-rating', 'SQ_confidence']]
+
+
+def comparable_homes(all_df, level):
+
+	'''Function keeping the homes in codes with at least 5 homes, grouped by code in order of first appearance.
+
+		RETURNS:
+			ALL (pd.DataFrame): homes that are compared to the EPC homes
+			HOMES (pd.DataFrame): their level, 'uprn' and 'calculatedAreaValue' columns without missing values
+	'''
+
+	ALL = all_df[all_df.groupby(level)[level].transform('size')>=5]		# only areas with at least 5 homes are compared
+	ALL = ALL.iloc[np.argsort(pd.factorize(ALL[level])[0], kind='stable')]
+	HOMES = ALL[[level, 'uprn', 'calculatedAreaValue']].dropna()
+
+	return ALL, HOMES
+
+
+def similar_homes(all_df, epc_df, level='postcode', precision=2, tolerance=0, index=None):
 
 	'''Function comparing homes in the epc databsse to all homes. Homes with a floor footprint
 		area withing a limit of precision to a home in the EPC database will be assumed to have 
@@ -71,67 +236,109 @@ def similar_homes(all_df, epc_df, level='postcode', precision=2):
 			level (str): area in which comparisons of area will be made between homes. Searches will only
 						be performed between homes in this area.
 			precision (int): area calculation for comparing homes is rounded to this precision.
+			tolerance (float): homes whose rounded areas differ by up to this many m2 also match, 0 for the same area.
+			index (AreaIndex): prebuilt index of epc_df at this level, built if not given.
 
 		RETURNS:
 			results (pd.DataFrame): dataframe containing the homes that can obtain a rating through this method
 	'''
 
-																
-	results = pd.DataFrame()						# initializing the data frame that will store the results
-	for code in all_df[level].unique():			# looping through all unique values in the selected level. 
-		EPC = epc_df[epc_df[level]==code]		# creating a subset EPC dataframe for the code being examined
-		ALL = all_df[all_df[level]==code]			# creating a subset proxy dataframe for the code being examined
-		if len(ALL)<5:
-			continue
-
-		EPC = EPC[['calculatedAreaValue', 'current-energy-rating', 'uprn']]		# segmenting out the required columns for the similarity matching
-		EPC['area'] = round(EPC['calculatedAreaValue'], precision)			# calculating the area from the polygon and rounding to the degree of precision.  
-		EPC['predicted'] = 0											# creating a new coulmn that indicates that this data is ground truth and not predicted
-		EPC.reset_index(inplace=True, drop=True)    					
-
-		temp_df = ALL.copy()											# creating a copy to preserve the larger dataframe inforamtion to attach after predictions 
-		ALL = ALL[['uprn', 'calculatedAreaValue']]									# segmenting out required columns. Reducing columns improves the computational time for merging.
-		ALL['area'] = round(ALL['calculatedAreaValue'],precision)				# calculating the area from the polygon and rounding to the degree of precision.  
-		ALL.reset_index(inplace=True, drop=True)
-		
-		prediction = EPC.merge(ALL[['area', 'uprn']], on='area', how='right', suffixes=('_epc', None))	# merging the two dataframes on the area column. Preserves the homes in the ALL df that match an area in the EPC df
-		prediction.dropna(inplace=True)									# removes all homes that do not have a match in the EPC
-		pred, area, uprn, conf = [],[],[],[]							# initializing lists.
-		for ID in prediction['uprn'].unique():							# looping through all the unique uprn values. One uprn could have multiple matches in the EPC df 
-			frame = prediction[prediction['uprn']==ID]					# Creates a segmented dataframe for the unique uprn
-			pred.append(frame['current-energy-rating'].mode()[0])		# taking the mode of the matching homes EPC rating
-			area.append(frame['area'].mode()[0])						# Taking the mode of the area jsut for convienience 
-			uprn.append(ID)												# grabbing the unique uprn for the property
-			highest_mode = len(frame[frame['current-energy-rating']==frame['current-energy-rating'].mode()[0]]) 			# getting all the ratings that correspond to the highest rating
-			perc = highest_mode/len(frame)		# getting the percentage of ratings that correspond to the most common rating
-			
-			''' This block assigns a confidence rating to the prediction based on the number of home with the same 
-				area have the same rating, and how many homes have that area. Ratings drop one tier if there is
-				only one home with the same area.
-			'''
-
-			if perc > 0.66:
-				if highest_mode > 1:
-					conf.append(0.8)
-				else:
-					conf.append(0.5)
-			elif (perc>0.33) and (perc<=0.66):
-				if highest_mode > 1:
-					conf.append(0.5)
-				else:
-					conf.append(0.3)
-			else:
-				conf.append(0.3)
-
-		dataframe = pd.DataFrame({'uprn':uprn, 'area':area, 'SQ_current-energy-rating':pred, 'SQ_confidence':conf})		# creating a dataframe for this code to store all of the matching homes
-		dataframe = temp_df.merge(dataframe, on='uprn', how='left', suffixes=(None, '_pred'))		# mreging the predicted data with the other coulmns in the initial dataframe so we have all information associated with the uprn
-		results = pd.concat([results,dataframe], axis=0)				# concatinating this with the larger results dataframe which stores the results for all areas
-		results.reset_index(inplace=True, drop=True)					
+	if index is None:
+		index = AreaIndex(epc_df, level)
+
+	ALL, HOMES = comparable_homes(all_df, level)
+	matches = index.query(HOMES, precision=precision, tolerance=tolerance)	# every EPC home with a similar area in the same code as each home
+	predictions = rating_modes(matches, [level, 'uprn'])
+
+	results = ALL.merge(predictions, on=[level, 'uprn'], how='left', suffixes=(None, '_pred'))		# merging the predicted data with the other coulmns in the initial dataframe so we have all information associated with the uprn
+	results.reset_index(inplace=True, drop=True)
+
+	return results
+
+
+def hierarchical_similar_homes(all_df, epc_df, levels=LEVELS, precision=2, tolerance=0, min_homes=5, min_matches=1, indexes=None):
+
+	'''Function comparing homes in the epc database to all homes at several levels, from the finest to the coarsest.
+		Each home gets its prediction from the finest level where its code has at least min_homes homes and the
+		home has at least min_matches similar EPC homes, so homes in sparse postcodes fall back to their LSOA
+		and then MSOA instead of getting no prediction. Each level queries its area index once for all homes
+		not resolved at a finer level.
+
+		INPUTS:
+			all_df (pd.DataFrame): dataframe containing the home and proxy information for all homes in the 
+					area of interest.
+			epc_df (pd.DataFrame): dataframe that contains data from properties in the EPC database 
+					in the area of interest.
+			levels (list): areas in which comparisons are made, finest first.
+			precision (int): area calculation for comparing homes is rounded to this precision.
+			tolerance (float): homes whose rounded areas differ by up to this many m2 also match, 0 for the same area.
+			min_homes (int): fewest homes a code must have for its homes to be compared at that level.
+			min_matches (int): fewest similar EPC homes needed to resolve a home at a level.
+			indexes (dict): prebuilt AreaIndex of epc_df for each level, built if not given.
+
+		RETURNS:
+			results (pd.DataFrame): homes compared at one or more levels, with 'SQ_level' the level the
+						prediction comes from (nan for homes without a prediction)
+	'''
+
+	if indexes is None:
+		indexes = {level: AreaIndex(epc_df, level) for level in levels}
 
+	ALL = all_df.reset_index(drop=True)
+	eligible = pd.DataFrame({level: ALL.groupby(level)[level].transform('size')>=min_homes for level in levels})		# codes with enough homes at each level
+	ALL = ALL[eligible.any(axis=1)]
+
+	HOMES = ALL[levels+['uprn', 'calculatedAreaValue']].dropna(subset=['uprn', 'calculatedAreaValue'])
+	HOMES = HOMES.assign(home=HOMES.index)
+
+	predictions = []
+	for level in levels:
+		remaining = HOMES[eligible.loc[HOMES.index, level]]					# homes not resolved at a finer level
+		matches = indexes[level].query(remaining, precision=precision, tolerance=tolerance, keys=['home'])
+		matches = matches[matches.groupby('home')['home'].transform('size')>=min_matches]
+
+		level_predictions = rating_modes(matches, ['home'])
+		level_predictions['SQ_level'] = level
+		predictions.append(level_predictions)
+		HOMES = HOMES[~HOMES['home'].isin(level_predictions['home'])]
+
+	predictions = pd.concat(predictions).set_index('home')
+	results = ALL.join(predictions, rsuffix='_pred')				# attaching the predictions to the other coulmns of each home
+	results.reset_index(inplace=True, drop=True)
 
 	return results
 
 
+def sweep(all_df, epc_df, level='postcode', precisions=[0, 1, 2], tolerances=[0, 0.5, 1, 2]):
+
+	'''Function comparing the match rate and confidence of precisions and tolerances, querying one index.
+
+		INPUTS:
+			all_df (pd.DataFrame): dataframe containing the home and proxy information for all homes.
+			epc_df (pd.DataFrame): dataframe that contains data from properties in the EPC database.
+			level (str): area in which comparisons of area will be made between homes.
+			precisions (list): precisions to try.
+			tolerances (list): tolerances in m2 to try with each precision.
+
+		RETURNS:
+			sweep_df (pd.DataFrame): precision, tolerance, number and share of homes matched and their mean confidence
+	'''
+
+	index = AreaIndex(epc_df, level)
+	ALL, HOMES = comparable_homes(all_df, level)
+
+	rows = []
+	for precision in precisions:
+		for tolerance in tolerances:
+			predictions = rating_modes(index.query(HOMES, precision=precision, tolerance=tolerance), [level, 'uprn'])
+			rows.append({'precision':precision, 'tolerance':tolerance, 'matched':len(predictions),
+						'match_rate':len(predictions)/len(HOMES) if len(HOMES) else np.nan,
+						'mean_confidence':predictions['SQ_confidence'].mean()})
+
+	return pd.DataFrame(rows)
+
+
+
 
 def main(epc_df=None, all_df=None):
 	'''Main function for preparing and seperating the epc and proxy data.
@@ -146,9 +353,9 @@ def main(epc_df=None, all_df=None):
 	if all_df.empty:
 		all_df = loading_all_homes_data()
 
-	results = similar_homes(all_df, epc_df, level='postcode', precision=2)
+	results = hierarchical_similar_homes(all_df, epc_df, levels=LEVELS, precision=2)
 
-	results.to_csv(OUTPUT_PATH+'SQ_results.csv', index=False)
+	storage.write_table(results, OUTPUT_PATH+'SQ_results')
 
 
 	return results
@@ -0,0 +1,127 @@
+######################################################################################
+#
+#   model/test_similarity_quantification.py
+#
+#   Checks the similarity quantification model on small synthetic data with a
+#   fixed seed: exact matching with similar_homes gives the same results as the
+#   original loop over postcodes and homes, and homes of sparse postcodes fall
+#   back to their LSOA. Run with `python -m pytest models`, or as a script from
+#   the models folder.
+#
+######################################################################################
+
+import pandas as pd
+import numpy as np
+
+import similarity_quantification_model as SQM
+
+
+SEED = 123
+
+
+def similar_homes_loop(all_df, epc_df, level='postcode', precision=2):
+	'''The original similar_homes, looping over each code and each matching home.'''
+
+	results = pd.DataFrame()
+	for code in all_df[level].unique():
+		EPC = epc_df[epc_df[level]==code]
+		ALL = all_df[all_df[level]==code]
+		if len(ALL)<5:
+			continue
+
+		EPC = EPC[['calculatedAreaValue', 'current-energy-rating', 'uprn']].copy()
+		EPC['area'] = round(EPC['calculatedAreaValue'], precision)
+		EPC['predicted'] = 0
+		EPC.reset_index(inplace=True, drop=True)
+
+		temp_df = ALL.copy()
+		ALL = ALL[['uprn', 'calculatedAreaValue']].copy()
+		ALL['area'] = round(ALL['calculatedAreaValue'],precision)
+		ALL.reset_index(inplace=True, drop=True)
+
+		prediction = EPC.merge(ALL[['area', 'uprn']], on='area', how='right', suffixes=('_epc', None))
+		prediction.dropna(inplace=True)
+		pred, area, uprn, conf = [],[],[],[]
+		for ID in prediction['uprn'].unique():
+			frame = prediction[prediction['uprn']==ID]
+			pred.append(frame['current-energy-rating'].mode()[0])
+			area.append(frame['area'].mode()[0])
+			uprn.append(ID)
+			highest_mode = len(frame[frame['current-energy-rating']==frame['current-energy-rating'].mode()[0]])
+			perc = highest_mode/len(frame)
+
+			if perc > 0.66:
+				conf.append(0.8 if highest_mode > 1 else 0.5)
+			elif (perc>0.33) and (perc<=0.66):
+				conf.append(0.5 if highest_mode > 1 else 0.3)
+			else:
+				conf.append(0.3)
+
+		dataframe = pd.DataFrame({'uprn':uprn, 'area':area, 'SQ_current-energy-rating':pred, 'SQ_confidence':conf})
+		dataframe = temp_df.merge(dataframe, on='uprn', how='left', suffixes=(None, '_pred'))
+		results = pd.concat([results,dataframe], axis=0)
+		results.reset_index(inplace=True, drop=True)
+
+	return results
+
+
+def synthetic_data(n_homes=400, n_epc=300, seed=SEED):
+	'''Homes and EPC homes in a few postcodes with a small set of footprint areas, so most homes have
+		several matches with mixed ratings. Postcode 'P9' has only 3 homes.'''
+
+	rng = np.random.default_rng(seed)
+	areas = np.round(rng.uniform(40, 120, 25), 3)
+
+	def homes(n, first_uprn):
+		postcode = rng.choice(['P0', 'P1', 'P2', 'P3', 'P4'], n)
+		return pd.DataFrame({
+			'uprn': np.arange(first_uprn, first_uprn+n),
+			'postcode': postcode,
+			'lsoa_code': np.where(np.isin(postcode, ['P0', 'P1']), 'L0', 'L1'),
+			'msoa_code': 'M0',
+			'calculatedAreaValue': rng.choice(areas, n),
+		})
+
+	all_df = homes(n_homes, 0)
+	all_df.loc[all_df.index[:3], 'postcode'] = 'P9'					# sparse postcode in LSOA 'L0'
+	all_df.loc[all_df.index[:3], 'lsoa_code'] = 'L0'
+
+	epc_df = homes(n_epc, 10000)
+	epc_df['current-energy-rating'] = rng.choice(list('ABCDEFG'), n_epc)
+	epc_df.loc[epc_df.index[:5], 'current-energy-rating'] = None
+
+	return all_df, epc_df
+
+
+def test_exact_matching():
+	'''similar_homes with tolerance 0 gives the same results as the original loop.'''
+
+	all_df, epc_df = synthetic_data()
+	expected = similar_homes_loop(all_df, epc_df)
+	results = SQM.similar_homes(all_df, epc_df, level='postcode', precision=2, tolerance=0)
+
+	assert results['SQ_current-energy-rating'].notna().sum() > 0
+	pd.testing.assert_frame_equal(results, expected, check_dtype=False)
+
+
+def test_fallback():
+	'''Homes of postcodes with fewer than 5 homes are resolved at their LSOA, the others at their postcode
+		when they have a match there.'''
+
+	all_df, epc_df = synthetic_data()
+	results = SQM.hierarchical_similar_homes(all_df, epc_df, levels=SQM.LEVELS, precision=2)
+	sparse = results[results['postcode']=='P9']
+	postcode_results = SQM.similar_homes(all_df, epc_df, level='postcode', precision=2)
+
+	assert len(sparse) == 3
+	assert set(sparse['SQ_level'].dropna()) <= {'lsoa_code', 'msoa_code'}
+	assert (sparse['SQ_level']=='lsoa_code').any()
+	assert (results['SQ_level']=='postcode').sum() == postcode_results['SQ_current-energy-rating'].notna().sum()
+
+
+if __name__ == '__main__':
+
+	test_exact_matching()
+	test_fallback()
+
+	print('It ran. Good job!')
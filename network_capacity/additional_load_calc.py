@@ -41,10 +41,16 @@ from tensorflow.keras.utils import to_categorical
 
 import inspect
 import gc
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'processing_data'))
+import storage
 
 DATA_PATH = '../data/processed/'
 PLOT_PATH = 'plots/'
 OUTPUT_PATH = 'outputs/'
+EPC_LOAD_COLUMNS = ['calculatedAreaValue', 'current-energy-rating', 'mainheat-description', 'energy-consumption-current', 'heating-cost-current']	# EPC columns used for calculating the additional loads
 
 CONFIG = {
 		'random_int': 123
@@ -201,9 +207,9 @@ def main():
 	'''
 
 
-	full_dataset = pd.read_csv('file_path_containing_epc_ratings_floor_area_and_heating_type') 			# loading the full dataset
+	full_dataset = storage.read_table('file_path_containing_epc_ratings_floor_area_and_heating_type') 			# loading the full dataset
 
-	epc_df = pd.read_csv(DATA_PATH+'cleaned_epc_data.csv') 			# loading the EPC dataset
+	epc_df = storage.read_table(DATA_PATH+'cleaned_epc_data', columns=EPC_LOAD_COLUMNS) 			# loading the EPC columns used for the loads
 
 	total_load, peak_load = calculating_additional_load(full_dataset, epc_df)
 
@@ -212,7 +218,7 @@ def main():
 	full_dataset['additional_peak_load'] = peak_load
 
 
-	full_dataset.to_csv(OUTPUT_PATH+'additional_load_calcs.csv', index=False)
+	storage.write_table(full_dataset, OUTPUT_PATH+'additional_load_calcs')
 
 
 if __name__ == '__main__':
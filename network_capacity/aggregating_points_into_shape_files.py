@@ -24,6 +24,11 @@ from shapely import wkt
 
 import inspect
 import gc
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'processing_data'))
+import storage
 
 DATA_PATH = 'data/shp_files/'
 OUTPUT_PATH = 'outputs/'
@@ -33,7 +38,7 @@ CONFIG = {
 		'rel_features': ['uprn', 'LATITUDE', 'LONGITUDE', 'current-energy-rating', 'mainheat-description', 'total-floor-area']
 							}
 
-properties = pd.read_csv('outputs/additional_load_values.csv')
+properties = storage.read_table('outputs/additional_load_values')
 
 properties['geometry'] = properties.apply(lambda row: Point(row['LONGITUDE'], row['LATITUDE']), axis=1)
 
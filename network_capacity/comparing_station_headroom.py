@@ -24,6 +24,11 @@ from shapely import wkt
 
 import inspect
 import gc
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'processing_data'))
+import storage
 
 SHP_PATH = 'data/shp_files/'
 DATA_PATH = 'data/'
@@ -36,7 +41,7 @@ CONFIG = {
 									'Demand Headroom (MVA)', 'Upstream Demand Headroom', 'geometry']
 							}
 
-properties = pd.read_csv(OUTPUT_PATH+'additional_load_values.csv')
+properties = storage.read_table(OUTPUT_PATH+'additional_load_values')
 stations = pd.read_csv(DATA_PATH+'WPD-Network-Capacity-Map-27-07-2022.csv')
 
 properties['geometry'] = properties.apply(lambda row: Point(row['LONGITUDE'], row['LATITUDE']), axis=1)
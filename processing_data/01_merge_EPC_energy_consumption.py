@@ -1,13 +1,14 @@
 
 import requests
 from bs4 import BeautifulSoup
-import json
 import pandas as pd
 import pickle
-from tqdm import tqdm
 import os
 from dotenv import load_dotenv, find_dotenv
 
+import storage
+import epc_harvester
+
 PROC_DATA_PATH = 'data/processed/'
 RAW_DATA_PATH = 'data/raw/'
 
@@ -68,41 +69,19 @@ load_dotenv(dotenv_path)
 AUTH_TOKEN = os.environ.get("EPC_AUTH_TOKEN")
 
 
-def get_epc_data(postcode, num_rows=5000):
-    """
-    Pull data from Domestic Energy Performance Certificates API.
-
-    Input:
-    postcode(str): (1) Postcode 
-    num_rows(int): Number of rows to pull. Max 5000 allowed at one time
-
-    Output:
-    (str): Pulled data from API
-
-    """
-    headers = {
-        'Authorization': f'Basic {AUTH_TOKEN}',
-        'Accept': 'application/json'
-    }
-    params = {
-        'postcode': postcode,
-        'size': num_rows
-    }
-    url = f'https://epc.opendatacommunities.org/api/v1/domestic/search'
-    res = requests.get(url, headers=headers, params=params)
-    return res.text
-
-
-# Pull WMCA postcode data and save as CSV
-result = list()
+# Harvest settings, EPC_URL can point at a local stub server
+EPC_URL = os.environ.get("EPC_URL", epc_harvester.EPC_URL)
+EPC_CONCURRENCY = int(os.environ.get("EPC_CONCURRENCY", 8))
+EPC_RATE = float(os.environ.get("EPC_RATE", 5))     # requests per second
 
-for code in tqdm(postcode_elec_consump_df.pcds.unique()):
-    requested_data = get_epc_data(code)
-    if len(requested_data)!=0:
-        result.extend(json.loads(requested_data)['rows'])
 
+# Pull WMCA postcode data, completed postcodes are checkpointed so a rerun resumes
+harvester = epc_harvester.EPCHarvester(
+    AUTH_TOKEN, PROC_DATA_PATH+'epc_checkpoint.jsonl', url=EPC_URL, concurrency=EPC_CONCURRENCY, rate=EPC_RATE
+)
+harvester.harvest(postcode_elec_consump_df.pcds.dropna().unique())
 
-EPC_data = pd.DataFrame(result)
+EPC_data = harvester.load()
 
 EPC_data['uprn'] = pd.to_numeric(EPC_data['uprn'],errors='coerce') # needs to be float for joining
 
@@ -137,6 +116,6 @@ EPC_postcode_elec_consump_fuel_poverty_uprn = pd.merge(old_df, uprn_df, left_on=
 EPC_postcode_elec_consump_fuel_poverty_uprn.drop(columns=["UPRN"], inplace=True)
 
 
-EPC_postcode_elec_consump_fuel_poverty_uprn.to_csv(PROC_DATA_PATH+"pre_clean_merged_epc_data.csv", index=False)
+storage.write_table(EPC_postcode_elec_consump_fuel_poverty_uprn, PROC_DATA_PATH+"pre_clean_merged_epc_data")
 
 
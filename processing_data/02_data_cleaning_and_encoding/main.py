@@ -31,6 +31,8 @@ import geopandas
 
 import inspect
 import gc
+import os
+import sys
 
 from data_cleaning import *
 from cleaning_categorical_data import *
@@ -38,6 +40,9 @@ from chaid import *
 from encoding_categorical import *
 from numerical_encoding import *
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import storage
+
 
 DATA_PATH = 'data/raw/'
 PLOT_PATH = 'plots/'
@@ -71,8 +76,8 @@ np.random.seed(CONFIG['random_int'])
 
 def main(config):
 
-	print('Loading intiial merged CSV....')
-	df = pd.read_csv(OUTPUT_PATH+'pre_clean_merged_epc_data.csv')
+	print('Loading intiial merged data....')
+	df = storage.read_table(OUTPUT_PATH+'pre_clean_merged_epc_data')
 
 	# # print(df)
 
@@ -80,27 +85,27 @@ def main(config):
 	print('Cleaning data....')
 	data_cleaning = DataCleaning(df, config['counties'], DATA_PATH, PLOT_PATH)
 	clean_df = DataCleaning.process(data_cleaning)
-	clean_df.to_csv(OUTPUT_PATH+'data_cleaning.csv', index=False)
+	storage.write_table(clean_df, OUTPUT_PATH+'data_cleaning')
 
 
 	# specifically cleaning the categorical data
 	print('Categorical Cleaning Data....')
 	categorical_cleaning = CleaningCategoricalData(clean_df)
 	categorical_df = CleaningCategoricalData.process(categorical_cleaning)
-	categorical_df.to_csv(OUTPUT_PATH+'cleaning_categorical_data.csv', index=False)
+	storage.write_table(categorical_df, OUTPUT_PATH+'cleaning_categorical_data')
 
 
 	# doing chaid grouping of the categorical data columns
 	print('CHAID cleaning....')
 	chaid_cleaning = CHAIDGrouping(categorical_df, OUTPUT_PATH)
 	chaid_df = CHAIDGrouping.process(chaid_cleaning)
-	chaid_df.to_csv(OUTPUT_PATH+'chaid_data.csv', index=False)
+	storage.write_table(chaid_df, OUTPUT_PATH+'chaid_data')
 
 	# numerically and one-hot encoding the categorical variables
 	print('Encoding Data....')
 	encoded_cleaning = EncodingCategorical(chaid_df, PLOT_PATH)
 	encoded_df = EncodingCategorical.process(encoded_cleaning)
-	encoded_df.to_csv(OUTPUT_PATH+'encoded_categorical.csv', index=False)
+	storage.write_table(encoded_df, OUTPUT_PATH+'encoded_categorical')
 
 	# numerically cleaning and imputing 
 	print('Numerical cleaning the data....')
@@ -108,7 +113,7 @@ def main(config):
 													parameters_to_drop=config['parameters_to_drop'], imputing_columns=config['imputing_columns'],
 													test_size=config['test_size'], random_int=config['random_int'])
 	numeric_df = CleaningNumericData.process(numeric_cleaning)
-	numeric_df.to_csv(OUTPUT_PATH+'cleaned_epc_data.csv', index=False)
+	storage.write_table(numeric_df, OUTPUT_PATH+'cleaned_epc_data')
 
 
 
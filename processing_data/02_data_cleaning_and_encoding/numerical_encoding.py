@@ -27,6 +27,11 @@ from sklearn.metrics import accuracy_score
 
 import inspect
 import gc
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import storage
 
 
 # setting random seed for reporducibility. SK learn uses numpy random seed.
@@ -147,7 +152,7 @@ def main(percent_missing_threshold=None, parameters_to_drop=None, imputing_colum
 	'''
 
 	print('Loading CSV....')
-	df = pd.read_csv('../../data/processed/encoding_categorical.csv')
+	df = storage.read_table('../../data/processed/encoding_categorical')
 	if parameters_to_drop == None:
 		parameters_to_drop = ['num_households_fuel_poverty','num_households',
 								'environment-impact-current','co2-emissions-current',
@@ -14,6 +14,12 @@ import rtree
 import matplotlib.pyplot as plt
 from typing import Optional, Dict
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+
+from os_cache import GMLCache
+from proxy_schema import apply_schema
+import storage
 
 
 RAW_DATA_PATH = 'data/raw/'
@@ -36,8 +42,10 @@ def merge_os_files(building_path, addressbase_path, topology_path):
 
     start = time.time()
     
-    add_df = gpd.read_file(addressbase_path, layer='BasicLandPropertyUnit', driver='GML')
-    top_df = gpd.read_file(topology_path, layer='TopographicArea', driver='GML')
+    # OS MasterMap GML layers converted once to GeoParquet
+    gml_cache = GMLCache()
+    add_df = gml_cache.read(addressbase_path, 'BasicLandPropertyUnit')
+    top_df = gml_cache.read(topology_path, 'TopographicArea')
     build_df = pd.read_csv(
                 building_path, 
                 header=None, 
@@ -52,11 +60,11 @@ def merge_os_files(building_path, addressbase_path, topology_path):
     add_df = add_df.to_crs('epsg:27700')
     
     top_df = top_df.merge(build_df, on='fid')
-    merged_df = gpd.sjoin(add_df, top_df, how="left")
 
-    merged_df = merged_df[merged_df['index_right'].notna()]
-    merged_df['geometry'] = merged_df['index_right'].apply(lambda col: top_df['geometry'][col])
-    merged_df.drop(columns=['index_right'], inplace=True)
+    join_start = time.time()
+    merged_df = point_in_polygon_join(add_df, top_df)
+    join_time = time.time() - join_start
+    print(f"Joined {len(add_df)} addresses to footprints in {join_time}s ({len(add_df) / max(join_time, 1e-9):.0f} addresses/s)")
 
     end = time.time()
     print(f"Completed merging data in {end-start}s")
@@ -64,37 +72,79 @@ def merge_os_files(building_path, addressbase_path, topology_path):
     return merged_df
 
 
+def point_in_polygon_join(points, polygons):
+    """
+    Inner join of points to the polygons they intersect, returning the polygon geometry.
+    Pairs come from one bulk spatial index query and rows are gathered with positional takes.
+
+    Input
+    points(GeoDataFrame): Address points
+    polygons(GeoDataFrame): Footprints in the same crs
+
+    Output
+    joined(GeoDataFrame): One row per matching (point, polygon) pair in point order, with the
+    attributes of both and the polygon geometry
+    """
+    point_idx, polygon_idx = polygons.sindex.query_bulk(points.geometry.values, predicate='intersects')
+    order = np.argsort(point_idx, kind='stable')
+    point_idx, polygon_idx = point_idx[order], polygon_idx[order]
+
+    left = pd.DataFrame(points.drop(columns=points.geometry.name)).iloc[point_idx]
+    right = pd.DataFrame(polygons.drop(columns=polygons.geometry.name)).iloc[polygon_idx].set_index(left.index)
+    geometry = polygons.geometry.values.take(polygon_idx)
+
+    return gpd.GeoDataFrame(pd.concat([left, right], axis=1), geometry=geometry, crs=polygons.crs)
+
+
 # In[17]:
 
 
-def loading_other(add_files):  
+# Local authorities in WMCA
+WMCA_code = ['E08000025', 'E08000031', 'E08000026', 'E08000027', 'E08000028', 'E08000029', 'E08000030', 
+                'E07000192', 'E07000218', 'E07000219', 'E07000236', 'E07000220', 'E06000051', 'E07000221', 
+                'E07000199', 'E06000020', 'E07000222']
+
+
+def loading_onsud():
     """
-    Load all fuel poverty and mapping data.
+    Load the postcode, LSOA, MSOA, local authority and constituency of each UPRN in WMCA, reading
+    only those columns.
 
     Returns
     pcd_lsoa_msoa_df(DataFrame): Mapping data for postcodes in the West Midlands
-    fuel_poverty_avg(float): average fuel poverty rating used to fill missing data 
-    energy_consump_df(DataFrame): Energy consumption data for the West Midlands
-    fuel_poverty_df(DataFrame): Fuel poverty data in the West Midlands
-
     """
     # Post code to LSOA to MSOA converting data
     # Retrieved from https://geoportal.statistics.gov.uk/datasets/ons-uprn-directory-august-2022/about
     
     PCD_LSOA_MSOA_PATH = RAW_DATA_PATH+"ONSUD_AUG_2022_WM.csv"
-    pcd_lsoa_msoa_df = pd.read_csv(PCD_LSOA_MSOA_PATH, low_memory=False, encoding='latin-1')
+    keep_col = ['UPRN', 'PCDS', 'lsoa11cd', 'msoa11cd', 'LAD21CD', 'PCON19CD']
+    col_names = ['uprn', 'postcode', 'lsoa_code', 'msoa_code', 'local-authority', 'constituency']
+    pcd_lsoa_msoa_df = pd.read_csv(PCD_LSOA_MSOA_PATH, usecols=keep_col, dtype={col: str for col in keep_col[1:]}, 
+                                   encoding='latin-1')
 
     # Filter for local authorities in WMCA
-    WMCA_code = ['E08000025', 'E08000031', 'E08000026', 'E08000027', 'E08000028', 'E08000029', 'E08000030', 
-                    'E07000192', 'E07000218', 'E07000219', 'E07000236', 'E07000220', 'E06000051', 'E07000221', 
-                    'E07000199', 'E06000020', 'E07000222']
     pcd_lsoa_msoa_df = pcd_lsoa_msoa_df[pcd_lsoa_msoa_df['LAD21CD'].isin(WMCA_code)]
 
     # Rename and select columns to keep
-    keep_col = ['UPRN', 'PCDS', 'lsoa11cd', 'msoa11cd', 'LAD21CD', 'PCON19CD']
-    col_names = ['uprn', 'postcode', 'lsoa_code', 'msoa_code', 'local-authority', 'constituency']
     pcd_lsoa_msoa_df = pcd_lsoa_msoa_df[keep_col]
-    pcd_lsoa_msoa_df = pcd_lsoa_msoa_df.rename(columns=dict(zip(keep_col,col_names)))
+    return pcd_lsoa_msoa_df.rename(columns=dict(zip(keep_col,col_names)))
+
+
+def loading_other(add_files, onsud=True):  
+    """
+    Load all fuel poverty and mapping data.
+
+    Input
+    onsud(bool): Also load the ONSUD mapping data, None is returned in its place otherwise
+
+    Returns
+    pcd_lsoa_msoa_df(DataFrame): Mapping data for postcodes in the West Midlands
+    fuel_poverty_avg(float): average fuel poverty rating used to fill missing data 
+    energy_consump_df(DataFrame): Energy consumption data for the West Midlands
+    fuel_poverty_df(DataFrame): Fuel poverty data in the West Midlands
+
+    """
+    pcd_lsoa_msoa_df = loading_onsud() if onsud else None
 
     # Load fuel poverty data
     # Retrieved from https://www.gov.uk/government/statistics/sub-regional-fuel-poverty-data-2022 
@@ -124,14 +174,90 @@ def loading_other(add_files):
 
 
 
-def map_add_info(gdf, energy_consump_df, pcd_lsoa_msoa_df, fuel_poverty_df, latlon, filename):
+GEOGRAPHY_COLUMNS = ['lsoa_code', 'msoa_code', 'local-authority', 'constituency']
+
+
+def uprn_keys(uprn):
+    "UPRNs as int64 search keys, -1 where missing or not numeric"
+    return pd.to_numeric(pd.Series(uprn), errors='coerce').fillna(-1).astype(np.int64).to_numpy()
+
+
+class GeographyIndex():
+    """
+    Postcode and geography codes of the ONSUD table indexed by UPRN, with the most common codes of
+    each postcode as fallback. Built once per run and shared by all tiles.
+
+    UPRNs are kept as a sorted int64 array searched with np.searchsorted (the last ONSUD row of a
+    duplicated UPRN wins) and postcodes as a pandas Index.
+    """
+    def __init__(self, pcd_lsoa_msoa_df, columns=GEOGRAPHY_COLUMNS):
+        print("Indexing geography...")
+        start = time.time()
+
+        self.columns = columns
+
+        keys = uprn_keys(pcd_lsoa_msoa_df['uprn'])
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        last = np.r_[keys[1:] != keys[:-1], True] if len(keys) else np.zeros(0, dtype=bool)
+        self.uprn = keys[last]
+        self.uprn_values = {
+            col: pcd_lsoa_msoa_df[col].to_numpy(dtype=object)[order][last] for col in ['postcode'] + columns
+        }
+
+        # Most common code of each postcode, smallest code on ties
+        postcodes = pd.Index(pcd_lsoa_msoa_df['postcode'].dropna().unique())
+        self.postcode = postcodes
+        self.postcode_values = {}
+        for col in columns:
+            counts = pcd_lsoa_msoa_df.groupby(['postcode', col]).size().reset_index(name='count')
+            counts = counts.sort_values(['postcode', 'count', col], ascending=[True, False, True])
+            modes = counts.drop_duplicates('postcode').set_index('postcode')[col]
+            self.postcode_values[col] = modes.reindex(postcodes).to_numpy(dtype=object)
+
+        end = time.time()
+        print(f"Indexed {len(self.uprn)} UPRNs and {len(self.postcode)} postcodes in {end-start}s")
+
+    def lookup_uprn(self, uprn, col):
+        "Values of a column for each UPRN, nan where not in the index"
+        keys = uprn_keys(uprn)
+        if not len(self.uprn):
+            return pd.Series(np.nan, index=range(len(keys)), dtype=object)
+        pos = np.minimum(np.searchsorted(self.uprn, keys), len(self.uprn) - 1)
+        found = (self.uprn[pos] == keys) & (keys >= 0)
+        return pd.Series(np.where(found, self.uprn_values[col][pos], np.nan), dtype=object)
+
+    def lookup_postcode(self, postcode, col):
+        "Most common value of a column for each postcode, nan where not in the index"
+        pos = self.postcode.get_indexer(pd.Series(postcode))
+        return pd.Series(np.where(pos >= 0, self.postcode_values[col][pos], np.nan), dtype=object)
+
+    def resolve(self, uprn, postcode):
+        """
+        Postcode and geography codes of homes: by UPRN, then by postcode where the UPRN has no code.
+
+        Input
+        uprn(Series): UPRN of each home
+        postcode(Series): Postcode of each home, filled from the UPRN where missing
+
+        Output
+        (DataFrame): 'postcode' and geography columns in the order of the inputs
+        """
+        out = pd.DataFrame({'postcode': pd.Series(postcode).reset_index(drop=True).astype(object)})
+        out['postcode'] = out['postcode'].fillna(self.lookup_uprn(uprn, 'postcode'))
+        for col in self.columns:
+            out[col] = self.lookup_uprn(uprn, col).fillna(self.lookup_postcode(out['postcode'], col))
+        return out
+
+
+def map_add_info(gdf, energy_consump_df, geography, fuel_poverty_df, latlon, filename):
     """
     Add LSOA, MSOA and local authority code, and fuel poverty data.
 
     Input
     gdf(GeoDataFrame): Merged OS dataframe
     energy_consump_df: energy consumption dataframe
-    pcd_lsoa_msoa_df: dataframe containing the geographic codes
+    geography: GeographyIndex, or the dataframe containing the geographic codes to index
     fuel_poverty_df: fuel poverty dataframe
     latlon: dataframe of latitude and longitude data
     filename(str): Name of saved output file
@@ -154,22 +280,15 @@ def map_add_info(gdf, energy_consump_df, pcd_lsoa_msoa_df, fuel_poverty_df, latl
     gdf = pd.merge(gdf, latlon, left_on="uprn", right_on="UPRN", how="left")
     gdf.drop(columns=["UPRN"], inplace=True)
     
-    cols_to_grab = ['lsoa_code', 'msoa_code', 'local-authority', 'constituency']
-    
-    temp_df = pd.DataFrame()
-    temp_df['postcode'] = pcd_lsoa_msoa_df['postcode']
-    temp_df[cols_to_grab] = pcd_lsoa_msoa_df[cols_to_grab]
-    temp_df = pcd_lsoa_msoa_df.groupby('postcode', as_index=False)[cols_to_grab].agg(pd.Series.mode)
+    if not isinstance(geography, GeographyIndex):
+        geography = GeographyIndex(geography)
         
-    # Map LSOA, MSOA and LA to postcode
-    for col in list(pcd_lsoa_msoa_df.columns)[1:]:
-        mapping = dict(zip(pcd_lsoa_msoa_df['uprn'], pcd_lsoa_msoa_df[col]))
-        if col in gdf.columns:
-            gdf[col] = gdf[col].fillna(gdf['uprn'].map(mapping))
-        else:
-            gdf[col] = gdf['uprn'].map(mapping)
-            gdf[col] = gdf[col].fillna(np.nan)
-            gdf[col] = gdf[col].fillna(gdf['postcode'].map(dict(zip(temp_df['postcode'], temp_df[col]))))
+    # Map postcode, LSOA, MSOA and LA to UPRN, falling back to postcode
+    map_start = time.time()
+    codes = geography.resolve(gdf['uprn'], gdf['postcode'])
+    for col in codes.columns:
+        gdf[col] = codes[col].to_numpy()
+    print(f"Mapped geography of {len(gdf)} homes in {time.time()-map_start}s")
     
         
     gdf = gdf[gdf['postcode'].isna()==False]
@@ -193,17 +312,18 @@ def map_add_info(gdf, energy_consump_df, pcd_lsoa_msoa_df, fuel_poverty_df, latl
 # In[14]:
 
 
-def encode_var(gdf, energy_consump_df, encode, fuel_poverty_avg, fuel_poverty_df, filename):
+def encode_var(gdf, energy_consump_df, encode, fuel_poverty_avg, fuel_poverty_df, filename, writer=None):
     """
-    Encode non-numeric variables for model training and fill numeric na with mean. Exported as csv.
+    Encode non-numeric variables for model training and fill numeric na with mean. Exported as Parquet.
 
     Input
     gdf(GeoDataFrame): Merged dataframe
     energy_consump_df: energy consumption dataframe
-    encode: dict containing the mapping key-value pairs
+    encode: dict containing the mapping key-value pairs, and the one hot categories if built by update_encoding
     fuel_povery_avg: national average fuel poverty used to fill missing values
     fuel_poverty_df: fuel poverty dataframe
     filename(str): Name of output file
+    writer(TableWriter): Append to an open table instead of saving filename, to encode tile by tile
 
     Returns:
     df: encoded dataframe
@@ -239,7 +359,12 @@ def encode_var(gdf, energy_consump_df, encode, fuel_poverty_avg, fuel_poverty_df
     label_encode_col = ['postcode', 'lsoa_code', 'msoa_code', 'constituency']
 
     for col in one_hot_col:
-        one_hot_encoded = pd.get_dummies(df[col], prefix=col)
+        if col in encode:
+            # Same dummy columns in every tile
+            categories = sorted(value for value in encode[col] if pd.notna(value))
+            one_hot_encoded = pd.get_dummies(pd.Categorical(df[col], categories=categories), prefix=col).set_index(df.index)
+        else:
+            one_hot_encoded = pd.get_dummies(df[col], prefix=col)
         df = pd.concat([df, one_hot_encoded], axis=1)
         df.drop(columns=[col], inplace=True)
 
@@ -247,53 +372,250 @@ def encode_var(gdf, energy_consump_df, encode, fuel_poverty_avg, fuel_poverty_df
         mapping = encode[col]
         df[col] = df[col].map(mapping)
 
+    df = apply_schema(df)
 
-    df.to_csv(OUTPUT_DIR+'{0}.csv'.format(filename), index=False)
+    if writer is not None:
+        writer.write(df)
+    else:
+        storage.write_table(df, OUTPUT_DIR+filename)
 
     print("Completed encoding variables.")
     return df
 
 
-def main():
+ENCODE_COLUMNS = ['postcode', 'lsoa_code', 'msoa_code', 'constituency', 'local-authority']
+
+
+def update_encoding(encode, df):
+    """
+    Add the values of a tile to the encoding dictionaries. Values are numbered in order of first
+    appearance, so the codes match encoding the concatenation of all tiles at once. Missing values
+    get no code and stay NaN; NaNs from different tiles are different objects, so adding them
+    would give one key per tile.
+
+    Input
+    encode(dict): Column to {value: code}, updated in place
+    df(DataFrame/dict): Tile output of map_add_info, or its unique values of each column
+
+    Returns:
+    encode: updated dict
+    """
+    for lvl in ENCODE_COLUMNS:
+        mapping = encode.setdefault(lvl, {})
+        for value in pd.Series(df[lvl]).dropna().unique():
+            mapping.setdefault(value, len(mapping))
+    return encode
+
+
+def write_partition(df, PARTITION_DIR, filename):
+    """
+    Save a tile output as a partition of the proxy dataset, via a temporary file.
+
+    Input
+    df(GeoDataFrame): Tile output of map_add_info
+    PARTITION_DIR(str): Folder of the partitioned dataset
+    filename(str): Tile name
+
+    Returns:
+    path(str): Path to partition
+    """
+    if not os.path.isdir(PARTITION_DIR):
+        os.makedirs(PARTITION_DIR)
+    path = PARTITION_DIR + '{0}.pkl'.format(filename)
+    df.to_pickle(path + '.tmp')
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def grid_reference(path):
+    "OS grid reference of a tile file, e.g. 'SP0585' from '5882272-sp0585.gml'"
+    return Path(path).stem.split('-')[-1].upper()
+
+
+def tile_manifest(building_height_files, address_files, topology_files):
+    """
+    Match building height, AddressBase and topology files of the same tile by OS grid reference.
+
+    Input
+    building_height_files(list): Paths to building height csv files
+    address_files(list): Paths to AddressBase gml files
+    topology_files(list): Paths to topology gml files
+
+    Returns:
+    tiles(list): (grid reference, building height, address, topology) of each tile sorted by grid reference
+    """
+    inputs = {}
+    for kind, files in [('building_height', building_height_files), ('address', address_files), ('topology', topology_files)]:
+        for path in files:
+            ref = grid_reference(path)
+            if kind in inputs.setdefault(ref, {}):
+                raise ValueError(f"Tile {ref} has more than one {kind} file: {inputs[ref][kind]}, {path}")
+            inputs[ref][kind] = path
+
+    incomplete = {ref: sorted({'building_height', 'address', 'topology'} - set(files)) for ref, files in inputs.items() if len(files) < 3}
+    if incomplete:
+        raise ValueError(f"{len(incomplete)} tiles are missing inputs: {incomplete}")
+
+    tiles = [(ref, files['building_height'], files['address'], files['topology']) for ref, files in sorted(inputs.items())]
+    print(f"Matched {len(tiles)} tiles")
+    return tiles
+
+
+# Letters of the OS National Grid 100km squares, I is not used
+GRID_LETTERS = 'ABCDEFGHJKLMNOPQRSTUVWXYZ'
+
+
+def grid_origin(ref):
+    """
+    South west corner and size of an OS grid reference square, e.g. 'SP0585' -> (405000, 285000, 1000).
+
+    Input
+    ref(str): Grid reference, two letters and an even number of digits
+
+    Returns:
+    easting(int), northing(int): Corner in meters
+    size(int): Side of the square in meters
+    """
+    l1, l2 = GRID_LETTERS.index(ref[0]), GRID_LETTERS.index(ref[1])
+    digits = len(ref[2:]) // 2
+    size = 10 ** (5 - digits)
+    easting = (((l1 - 2) % 5) * 5 + l2 % 5) * 100000 + (int(ref[2:2+digits]) * size if digits else 0)
+    northing = (19 - (l1 // 5) * 5 - l2 // 5) * 100000 + (int(ref[2+digits:]) * size if digits else 0)
+    return easting, northing, size
+
+
+def split_uprn_coordinates(refs, LATLON_DIR, chunksize=1000000):
+    """
+    Split the latitude and longitude of OS Open UPRN by tile, so each worker reads its own tile only.
+    The csv is streamed in chunks reading only the UPRN and coordinate columns, and UPRNs outside the
+    tiles are dropped.
+
+    Input
+    refs(list): Grid references of the tiles
+    LATLON_DIR(str): Folder of the tables of each tile
+    chunksize(int): Rows of the csv read at once
+
+    Returns:
+    paths(dict): Grid reference to path of its table
+    """
+    print("Splitting UPRN coordinates by tile...")
+    start = time.time()
+
+    # Integer key of each tile from its corner, per tile size
+    keys = defaultdict(dict)
+    for ref in refs:
+        easting, northing, size = grid_origin(ref)
+        keys[size][easting // size * 10**7 + northing // size] = ref
+
+    parts = defaultdict(list)
+    columns = {'UPRN': np.int64, 'X_COORDINATE': np.float64, 'Y_COORDINATE': np.float64, 
+               'LATITUDE': np.float64, 'LONGITUDE': np.float64}
+    for chunk in pd.read_csv(RAW_DATA_PATH+'osopenuprn_202205.csv', usecols=list(columns), dtype=columns, chunksize=chunksize):
+        for size, tiles in keys.items():
+            key = (chunk['X_COORDINATE'] // size).astype(np.int64) * 10**7 + (chunk['Y_COORDINATE'] // size).astype(np.int64)
+            for ref, part in chunk.groupby(key.map(tiles)):
+                parts[ref].append(part[['UPRN', 'LATITUDE', 'LONGITUDE']])
+
+    empty = pd.DataFrame({col: pd.Series(dtype=columns[col]) for col in ['UPRN', 'LATITUDE', 'LONGITUDE']})
+    paths = {}
+    for ref in refs:
+        latlon = pd.concat(parts.pop(ref), ignore_index=True) if ref in parts else empty
+        paths[ref] = storage.write_table(latlon, LATLON_DIR + ref)
+
+    end = time.time()
+    print(f"Split UPRN coordinates of {len(refs)} tiles in {end-start}s")
+    return paths
+
+
+# Lookup tables of a worker process, set once by load_worker_tables
+worker_tables = {}
+
+
+def load_worker_tables(energy_consump_df, fuel_poverty_df):
+    """
+    Index the ONSUD geography once per worker process and keep the small tables passed by the
+    parent process, which does not load ONSUD itself.
+    """
+    worker_tables.update(
+        geography=GeographyIndex(loading_onsud()), energy_consump_df=energy_consump_df, fuel_poverty_df=fuel_poverty_df
+    )
+
+
+def process_tile(build, address, top, latlon_path, PARTITION_DIR):
+    """
+    Merge and add info to one tile in a worker process and save it as a partition.
+
+    Input
+    build(str): Path to building height csv
+    address(str): Path to AddressBase gml
+    top(str): Path to topology gml
+    latlon_path(str): Path to the UPRN coordinates of the tile, from split_uprn_coordinates
+    PARTITION_DIR(str): Folder of the partitioned dataset
+
+    Returns:
+    path(str): Path to partition
+    values(dict): Unique values of each encoded column, for update_encoding
+    """
+    merged_df = merge_os_files(build, address, top)
+    filename = Path(address).stem
+    df = map_add_info(merged_df, worker_tables['energy_consump_df'], worker_tables['geography'],
+                      worker_tables['fuel_poverty_df'], storage.read_table(latlon_path), filename)
+    path = write_partition(df, PARTITION_DIR, filename)
+
+    return path, {lvl: df[lvl].unique() for lvl in ENCODE_COLUMNS}
+
+
+def main(workers=None):
     """
     Assign all homes in AddressBasePremium to its building footprint from OSMap Topography and building 
     height from OSMap Building Height Attribute. Building shapefiles saved in 'output' as .gml
+
+    Tiles are matched by grid reference and streamed: each tile is written as a partition by a worker
+    process while the encoding dictionaries are built in tile order, then a second pass encodes the
+    partitions one at a time so only one tile is in memory. UPRN coordinates are split by tile
+    beforehand, and each worker indexes ONSUD once and reads the coordinates of its own tiles only.
     """
-    address_dir = RAW_DATA_DIR +'landbaseprem/'
-    building_height_dir = RAW_DATA_DIR+'building_height/'
-    topology_dir = RAW_DATA_DIR+'topology/'
-    latlon = RAW_DATA_DIR+'osopenuprn_202205.csv'
-    latlon = pd.read_csv(latlon)
+    address_dir = RAW_DATA_PATH +'landbaseprem/'
+    building_height_dir = RAW_DATA_PATH+'building_height/'
+    topology_dir = RAW_DATA_PATH+'topology/'
     
     building_height_files = glob.glob(building_height_dir+'*.csv')
     address_files = glob.glob(address_dir+"*.gml")
     topology_files = glob.glob(topology_dir+"*.gml")
+    tiles = tile_manifest(building_height_files, address_files, topology_files)
 
-    final_output_df = pd.DataFrame()
-    pcd_lsoa_msoa_df, fuel_poverty_avg, energy_consump_df, fuel_poverty_df = loading_other(address_files)
+    PARTITION_DIR = 'data/processed/proxy_partitions/'
+    LATLON_DIR = 'data/interim/uprn_latlon/'
+    _, fuel_poverty_avg, energy_consump_df, fuel_poverty_df = loading_other(address_files, onsud=False)
+    latlon_paths = split_uprn_coordinates([ref for ref, _, _, _ in tiles], LATLON_DIR)
 
-    for build, address, top in zip(building_height_files, address_files, topology_files):
-        merged_df = merge_os_files(build, address, top)
-        filename = Path(address).stem
-        df = map_add_info(merged_df, energy_consump_df, pcd_lsoa_msoa_df, fuel_poverty_df, latlon, filename)
-        final_output_df = pd.concat([final_output_df, df], axis=0)
-        
-    print('Loading postcode encoding stuff....')
-    map_df = final_output_df[['postcode', 'lsoa_code', 'msoa_code', 'constituency']]
-    
-    # Create dictionary for one hot encoding
+    # First pass: tile outputs to partitions in a worker pool, encoding dictionaries in tile order
     encode = {}
-    for lvl in ['postcode', 'lsoa_code', 'msoa_code', 'constituency']:
-        unq_var = map_df[lvl].unique()
-        encode[lvl] = dict(zip(unq_var, np.arange(len(unq_var))))
-    encode_var(final_output_df, energy_consump_df, encode, fuel_poverty_avg, fuel_poverty_df, 'merged_and_encoded_proxies')
+    partitions = []
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=load_worker_tables, 
+                             initargs=(energy_consump_df, fuel_poverty_df)) as executor:
+        futures = [executor.submit(process_tile, build, address, top, latlon_paths[ref], PARTITION_DIR) for ref, build, address, top in tiles]
+        for (ref, _, _, _), future in zip(tiles, futures):
+            path, values = future.result()
+            partitions.append(path)
+            update_encoding(encode, values)
+            print(f"Completed tile {ref}")
+
+    # Second pass: encode partitions into one table
+    print('Encoding partitions....')
+    with storage.TableWriter('data/processed/encoded_proxy/merged_and_encoded_proxies') as writer:
+        for path in partitions:
+            encode_var(pd.read_pickle(path), energy_consump_df, encode, fuel_poverty_avg, fuel_poverty_df, 'merged_and_encoded_proxies', writer)
 
 
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes, defaults to number of cores')
+    args = parser.parse_args()
 
-    main()
+    main(args.workers)
 
     print('It ran. Good job.')
 
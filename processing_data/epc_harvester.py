@@ -0,0 +1,180 @@
+import aiohttp
+import asyncio
+import pandas as pd
+import json
+import time
+import os
+
+
+EPC_URL = 'https://epc.opendatacommunities.org/api/v1/domestic/search'
+
+
+class TokenBucket():
+    """
+    Token bucket limiting the request rate: up to capacity requests at once, refilled at rate per second.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity else max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        "Wait for a token"
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class EPCHarvester():
+    """
+    Domestic EPC certificates of many postcodes pulled concurrently from the EPC API.
+
+    Requests share one connection pool, at most `concurrency` postcodes are in flight and requests
+    are limited to `rate` per second. Postcodes with more than `page_size` certificates are paged
+    with search-after. Every completed postcode is appended to a json lines checkpoint, and postcodes
+    already in the checkpoint are skipped, so an interrupted harvest continues where it stopped.
+    Failed requests are retried up to `retries` times, waiting `backoff` seconds doubled on each retry.
+    """
+    def __init__(self, auth_token, CHECKPOINT_PATH, url=EPC_URL, concurrency=8, rate=5, page_size=5000, retries=5, backoff=1):
+        self.auth_token = auth_token
+        self.CHECKPOINT_PATH = CHECKPOINT_PATH
+        self.url = url
+        self.concurrency = concurrency
+        self.rate = rate
+        self.page_size = page_size
+        self.retries = retries
+        self.backoff = backoff
+
+    def done_postcodes(self):
+        "Postcodes already in the checkpoint, ignoring a line cut off by a crash"
+        done = set()
+        if not os.path.isfile(self.CHECKPOINT_PATH):
+            return done
+        with open(self.CHECKPOINT_PATH, 'r') as f:
+            for line in f:
+                try:
+                    done.add(json.loads(line)['postcode'])
+                except (json.JSONDecodeError, KeyError):
+                    continue
+        return done
+
+    def append_checkpoint(self, postcode, rows):
+        "Append the certificates of a completed postcode to the checkpoint"
+        with open(self.CHECKPOINT_PATH, 'a') as f:
+            f.write(json.dumps({'postcode': postcode, 'rows': rows}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def get_page(self, session, bucket, postcode, search_after=None):
+        """
+        One page of certificates of a postcode, retrying rate limited, failed and timed out requests
+        with exponential backoff.
+
+        Input
+        session(aiohttp.ClientSession): Shared session
+        bucket(TokenBucket): Request rate limiter
+        postcode(str): Postcode
+        search_after(str): Value of the previous page's X-Next-Search-After header
+
+        Output
+        rows(list): Certificates of the page
+        search_after(str): Key of the next page, None on the last page
+        """
+        params = {'postcode': postcode, 'size': self.page_size}
+        if search_after is not None:
+            params['search-after'] = search_after
+
+        for attempt in range(self.retries + 1):
+            await bucket.acquire()
+            try:
+                async with session.get(self.url, params=params) as res:
+                    if res.status == 429 or res.status >= 500:
+                        raise aiohttp.ClientResponseError(res.request_info, res.history, status=res.status)
+                    res.raise_for_status()
+                    text = await res.text()
+                    next_search_after = res.headers.get('X-Next-Search-After')
+                break
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.retries or (isinstance(e, aiohttp.ClientResponseError) and e.status < 500 and e.status != 429):
+                    raise
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+
+        # Postcodes without certificates return an empty body
+        rows = json.loads(text)['rows'] if text else []
+        if len(rows) < self.page_size:
+            next_search_after = None
+        return rows, next_search_after
+
+    async def get_postcode(self, session, bucket, semaphore, postcode):
+        """
+        All certificates of a postcode, following search-after pages, appended to the checkpoint.
+        A postcode rejected by the API (4xx other than 429, e.g. malformed) is logged and
+        checkpointed without certificates rather than stopping the harvest.
+        """
+        async with semaphore:
+            try:
+                rows, search_after = await self.get_page(session, bucket, postcode)
+                while search_after is not None:
+                    page, search_after = await self.get_page(session, bucket, postcode, search_after)
+                    rows.extend(page)
+            except aiohttp.ClientResponseError as e:
+                if not 400 <= e.status < 500 or e.status == 429:
+                    raise
+                print(f"Skipping postcode {postcode!r}: HTTP {e.status}")
+                rows = []
+        self.append_checkpoint(postcode, rows)
+        return len(rows)
+
+    async def harvest_async(self, postcodes):
+        "Pull all postcodes not yet in the checkpoint"
+        done = self.done_postcodes()
+        todo = [postcode for postcode in dict.fromkeys(postcodes) if postcode not in done]
+        print(f"Harvesting {len(todo)} postcodes, skipping {len(done)} already in checkpoint...")
+        start = time.time()
+
+        headers = {'Authorization': f'Basic {self.auth_token}', 'Accept': 'application/json'}
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        bucket = TokenBucket(self.rate)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        async with aiohttp.ClientSession(headers=headers, connector=connector, timeout=aiohttp.ClientTimeout(total=120)) as session:
+            tasks = [asyncio.create_task(self.get_postcode(session, bucket, semaphore, postcode)) for postcode in todo]
+            n_rows = 0
+            for i, task in enumerate(asyncio.as_completed(tasks), 1):
+                n_rows += await task
+                if i % 1000 == 0 or i == len(tasks):
+                    print(f"Harvested {i}/{len(tasks)} postcodes, {n_rows} certificates in {time.time()-start}s")
+
+    def harvest(self, postcodes):
+        """
+        Pull the certificates of all postcodes into the checkpoint.
+
+        Input
+        postcodes(list): Postcodes to pull
+        """
+        if os.path.dirname(self.CHECKPOINT_PATH) and not os.path.isdir(os.path.dirname(self.CHECKPOINT_PATH)):
+            os.makedirs(os.path.dirname(self.CHECKPOINT_PATH))
+        asyncio.run(self.harvest_async(postcodes))
+
+    def load(self):
+        """
+        Dataframe of all certificates in the checkpoint.
+
+        Output
+        (DataFrame): One row per certificate
+        """
+        rows = []
+        with open(self.CHECKPOINT_PATH, 'r') as f:
+            for line in f:
+                try:
+                    rows.extend(json.loads(line)['rows'])
+                except (json.JSONDecodeError, KeyError):
+                    continue
+        return pd.DataFrame(rows)
@@ -0,0 +1,130 @@
+import geopandas as gpd
+from pathlib import Path
+import hashlib
+import json
+import time
+import os
+
+
+# Cache shared by processing_data and solar_pv, resolved from this file so it does not depend on the working directory
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'interim', 'gml_cache', '')
+
+# Columns used from each OS MasterMap GML layer
+LAYER_COLUMNS = {
+    'TopographicArea': ['fid', 'calculatedAreaValue'],
+    'BasicLandPropertyUnit': ['uprn', 'postcode', 'buildingNumber', 'thoroughfare', 'parentUPRN']
+}
+
+
+class GMLCache():
+    """
+    OS MasterMap GML layers converted once to GeoParquet with only the columns the project uses.
+
+    Each converted layer is stored in CACHE_DIR next to a json record of the source file's size,
+    modification time and sha256. A cache whose source has changed content is rebuilt; a source
+    that was only touched is re-hashed and kept. CACHE_DIR is created on the first conversion.
+    """
+    def __init__(self, CACHE_DIR=CACHE_DIR):
+        self.CACHE_DIR = CACHE_DIR
+
+    def cache_path(self, path, layer):
+        "Path of the GeoParquet file for a layer of a GML file"
+        return self.CACHE_DIR + f"{Path(path).stem}_{layer}.parquet"
+
+    def file_hash(self, path):
+        "sha256 of a file's content"
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    def is_fresh(self, path, layer):
+        """
+        Whether the cached layer was converted from the current content of the GML file.
+
+        Input
+        path(str): Path to GML file
+        layer(str): GML layer name
+
+        Output
+        (bool): True if the cache can be used
+        """
+        cache = self.cache_path(path, layer)
+        if not (os.path.isfile(cache) and os.path.isfile(cache + '.json')):
+            return False
+
+        with open(cache + '.json', 'r') as f:
+            record = json.load(f)
+        stat = os.stat(path)
+        if record['size'] == stat.st_size and record['mtime'] == stat.st_mtime:
+            return True
+        if record['size'] != stat.st_size or record['sha256'] != self.file_hash(path):
+            return False
+
+        # Touched but unchanged, remember the new modification time
+        record['mtime'] = stat.st_mtime
+        self.write_record(cache, record)
+        return True
+
+    def write_record(self, cache, record):
+        "Write the source record of a cached layer via a temporary file"
+        with open(cache + '.json.tmp', 'w') as f:
+            json.dump(record, f, indent=2)
+        os.replace(cache + '.json.tmp', cache + '.json')
+
+    def convert(self, path, layer):
+        """
+        Parse a GML layer and store its used columns as GeoParquet.
+
+        Input
+        path(str): Path to GML file
+        layer(str): GML layer name, key of LAYER_COLUMNS
+
+        Output
+        (str): Path to GeoParquet file
+        """
+        print(f"Converting {layer} of {Path(path).name} to GeoParquet...")
+        start = time.time()
+
+        os.makedirs(self.CACHE_DIR, exist_ok=True)
+        stat = os.stat(path)
+        gdf = gpd.read_file(path, layer=layer, driver='GML')
+        gdf = gdf[LAYER_COLUMNS[layer] + ['geometry']]
+
+        cache = self.cache_path(path, layer)
+        gdf.to_parquet(f"{cache}.{os.getpid()}.tmp")
+        os.replace(f"{cache}.{os.getpid()}.tmp", cache)
+        self.write_record(cache, {
+            'source': str(path), 'layer': layer, 'size': stat.st_size, 'mtime': stat.st_mtime,
+            'sha256': self.file_hash(path)
+        })
+
+        end = time.time()
+        print(f"Completed converting {len(gdf)} features in {end-start}s")
+        return cache
+
+    def read(self, path, layer, columns=None, bbox=None):
+        """
+        GeoDataFrame of a GML layer read from the cache, converting it first if missing or stale.
+
+        Input
+        path(str): Path to GML file
+        layer(str): GML layer name, key of LAYER_COLUMNS
+        columns(list): Columns to read besides geometry, defaults to all cached columns
+        bbox(tuple): (xmin, ymin, xmax, ymax) to keep only features whose bounding box intersects it.
+                     The whole layer is still read, the filter only shrinks the returned frame.
+
+        Output
+        (GeoDataFrame): Layer features
+        """
+        if not self.is_fresh(path, layer):
+            self.convert(path, layer)
+
+        columns = LAYER_COLUMNS[layer] if columns is None else columns
+        gdf = gpd.read_parquet(self.cache_path(path, layer), columns=list(columns) + ['geometry'])
+        if bbox is not None:
+            # Features whose bounding box intersects bbox
+            xmin, ymin, xmax, ymax = bbox
+            gdf = gdf.cx[xmin:xmax, ymin:ymax]
+        return gdf
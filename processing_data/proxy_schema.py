@@ -0,0 +1,81 @@
+import pandas as pd
+import numpy as np
+
+import storage
+
+
+# Declared dtypes of the merged proxy dataset
+PROXY_SCHEMA = {
+    'uprn': 'int64',
+    # label encoded codes from encode_var
+    'postcode': 'int32',
+    'lsoa_code': 'int32',
+    'msoa_code': 'int32',
+    'constituency': 'int32',
+    # building and area attributes
+    'calculatedAreaValue': 'float32',
+    'RelHMax': 'float32',
+    'AbsHMin': 'float32',
+    'AbsHMax': 'float32',
+    'num_households': 'float32',
+    'num_households_fuel_poverty': 'float32',
+    'prop_households_fuel_poor': 'float32',
+    'total_consumption': 'float32',
+    'mean_counsumption': 'float32',
+    'median_consumption': 'float32',
+    # coordinates keep float64, float32 would round them to ~0.5 m
+    'LATITUDE': 'float64',
+    'LONGITUDE': 'float64',
+}
+
+# One hot columns from encode_var
+ONE_HOT_PREFIXES = ['local-authority_']
+
+
+def schema_dtype(col):
+    "Declared dtype of a proxy column, None if the column is not in the schema"
+    if col in PROXY_SCHEMA:
+        return PROXY_SCHEMA[col]
+    if any(col.startswith(prefix) for prefix in ONE_HOT_PREFIXES):
+        return 'uint8'
+    return None
+
+
+def apply_schema(df):
+    """
+    Cast the proxy columns of a dataframe to the declared schema. Integer columns with
+    missing values use the nullable integer dtype of the same width, so every tile of a
+    table gets the same schema. Columns outside the schema are left as they are.
+
+    Input
+    df(DataFrame): Proxy data
+
+    Returns:
+    df: dataframe with compact dtypes
+    """
+    for col in df.columns:
+        dtype = schema_dtype(col)
+        if dtype is None or df[col].dtype == dtype or (dtype in ['int64', 'int32'] and df[col].dtype == dtype.capitalize()):
+            continue
+        if dtype in ['int64', 'int32'] and df[col].isna().any():
+            dtype = dtype.capitalize()
+        df[col] = df[col].astype(dtype)
+    return df
+
+
+def read_proxies(path, columns=None, filters=None):
+    """
+    Read a proxy table with the declared schema. Falls back to csv, parsing the float columns
+    straight to float32.
+
+    Input
+    path(str): Path of the table, with or without extension
+    columns(list): Columns to read, defaults to all
+    filters(list): (column, op, value) filters that must all match
+
+    Returns:
+    df: dataframe with compact dtypes
+    """
+    dtypes = {col: np.float32 for col, dtype in PROXY_SCHEMA.items() if dtype in ['float32', 'int32']}
+    df = storage.read_table(path, columns=columns, filters=filters, csv_dtype=dtypes)
+    return apply_schema(df)
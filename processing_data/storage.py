@@ -0,0 +1,128 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pathlib import Path
+import operator
+import os
+
+
+# Also write a csv copy of every table, set EXPORT_CSV=1 to export
+EXPORT_CSV = os.environ.get('EXPORT_CSV', '0') == '1'
+
+# Operators of (column, op, value) filters, as accepted by pd.read_parquet
+OPERATORS = {
+    '==': operator.eq, '=': operator.eq, '!=': operator.ne,
+    '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge,
+    'in': lambda col, value: col.isin(value), 'not in': lambda col, value: ~col.isin(value)
+}
+
+
+def table_path(path, suffix='.parquet'):
+    "Path of a table with the given file extension, e.g. 'outputs/SQ_results.csv' -> 'outputs/SQ_results.parquet'"
+    return str(Path(path).with_suffix(suffix))
+
+
+def write_table(df, path, csv=None):
+    """
+    Save a dataframe as Parquet, via a temporary file so readers never see half-written tables.
+
+    Input
+    df(DataFrame): Table to save
+    path(str): Path of the table, with or without extension
+    csv(bool): Also save a csv copy, defaults to EXPORT_CSV
+
+    Returns:
+    path(str): Path to Parquet file
+    """
+    parquet = table_path(path)
+    if os.path.dirname(parquet) and not os.path.isdir(os.path.dirname(parquet)):
+        os.makedirs(os.path.dirname(parquet))
+
+    df.to_parquet(parquet + '.tmp', index=False)
+    os.replace(parquet + '.tmp', parquet)
+
+    if csv or (csv is None and EXPORT_CSV):
+        df.to_csv(table_path(path, '.csv'), index=False)
+    return parquet
+
+
+def apply_filters(df, filters):
+    "Rows of a dataframe matching all (column, op, value) filters"
+    if not filters:
+        return df
+    mask = pd.Series(True, index=df.index)
+    for col, op, value in filters:
+        mask &= OPERATORS[op](df[col], value)
+    return df[mask]
+
+
+def read_table(path, columns=None, filters=None, csv_dtype=None):
+    """
+    Load a table, reading only the requested columns and rows. Reads the Parquet file if it exists
+    and falls back to a csv of the same name, so tables from before the Parquet switch still load.
+
+    Input
+    path(str): Path of the table, with or without extension
+    columns(list): Columns to read, defaults to all
+    filters(list): (column, op, value) filters that must all match, e.g. [('predicted', '==', 1)]
+    csv_dtype(dict): dtypes used when falling back to csv
+
+    Returns:
+    df: loaded dataframe
+    """
+    parquet = table_path(path)
+    if os.path.exists(parquet):
+        return pd.read_parquet(parquet, columns=columns, filters=filters or None)
+
+    df = pd.read_csv(table_path(path, '.csv'), usecols=columns, dtype=csv_dtype, low_memory=False)
+    return apply_filters(df, filters).reset_index(drop=True)
+
+
+class TableWriter():
+    """
+    Table written part by part (e.g. one tile at a time) into a single Parquet file.
+
+    The first part fixes the columns and schema, later parts are reordered to match. The file is
+    moved into place on close so readers never see a partial table.
+    """
+    def __init__(self, path, csv=None):
+        self.path = table_path(path)
+        self.csv = EXPORT_CSV if csv is None else csv
+        self.writer = None
+        self.rows = 0
+        if os.path.dirname(self.path) and not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+
+    def write(self, df):
+        "Append a part to the table"
+        if self.writer is None:
+            self.columns = df.columns
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            self.schema = table.schema
+            self.writer = pq.ParquetWriter(self.path + '.tmp', self.schema)
+        else:
+            df = df.reindex(columns=self.columns)
+            table = pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+        self.writer.write_table(table)
+
+        if self.csv:
+            df.to_csv(table_path(self.path, '.csv'), mode='a' if self.rows else 'w', header=not self.rows, index=False)
+        self.rows += len(df)
+
+    def close(self):
+        "Finish the table and move it into place"
+        if self.writer is not None:
+            self.writer.close()
+            os.replace(self.path + '.tmp', self.path)
+        return self.path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.writer is not None:
+            # Leave no partial table behind
+            self.writer.close()
+            os.remove(self.path + '.tmp')
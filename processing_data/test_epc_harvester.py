@@ -0,0 +1,103 @@
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+import asyncio
+import json
+from collections import Counter
+
+import pytest
+
+from epc_harvester import EPCHarvester
+
+
+# Certificates of each postcode served by the stub API
+ROWS = {
+    'PAGED': [{'lmk-key': str(i), 'postcode': 'PAGED'} for i in range(5)],
+    'FLAKY': [{'lmk-key': 'flaky', 'postcode': 'FLAKY'}],
+}
+
+# Failed responses a postcode gets before the stub answers normally
+FAILURES = {'FLAKY': [429, 503]}
+
+
+def stub_app():
+    """
+    Stub of the EPC search API: pages with search-after like the real API, answers 400 to 'BAD',
+    an empty body to 'EMPTY' and 500 to 'DOWN'. Returns the app and the count of requests of each postcode.
+    """
+    requests = Counter()
+
+    async def search(request):
+        postcode = request.query['postcode']
+        requests[postcode] += 1
+        failures = FAILURES.get(postcode, [])
+        if requests[postcode] <= len(failures):
+            return web.Response(status=failures[requests[postcode] - 1])
+        if postcode == 'BAD':
+            return web.Response(status=400)
+        if postcode == 'DOWN':
+            return web.Response(status=500)
+        if postcode not in ROWS:
+            return web.Response(text='')
+
+        size = int(request.query['size'])
+        first = int(request.query.get('search-after', 0))
+        rows = ROWS[postcode][first:first+size]
+        return web.json_response({'rows': rows}, headers={'X-Next-Search-After': str(first + len(rows))})
+
+    app = web.Application()
+    app.router.add_get('/api/v1/domestic/search', search)
+    return app, requests
+
+
+async def harvest(app, CHECKPOINT_PATH, postcodes, **params):
+    "Harvest postcodes from the stub app"
+    server = TestServer(app)
+    await server.start_server()
+    try:
+        harvester = EPCHarvester('token', CHECKPOINT_PATH, url=str(server.make_url('/api/v1/domestic/search')),
+                                 rate=1000, page_size=2, backoff=0.01, **params)
+        await harvester.harvest_async(postcodes)
+    finally:
+        await server.close()
+
+
+def test_paging_skipping_and_retries(tmp_path):
+    "Pages are followed, rejected postcodes skipped and rate limited or failed requests retried"
+    CHECKPOINT_PATH = str(tmp_path / 'checkpoint.jsonl')
+    app, requests = stub_app()
+    asyncio.run(harvest(app, CHECKPOINT_PATH, ['PAGED', 'BAD', 'EMPTY', 'FLAKY']))
+
+    assert requests == {'PAGED': 3, 'BAD': 1, 'EMPTY': 1, 'FLAKY': 3}
+    with open(CHECKPOINT_PATH, 'r') as f:
+        checkpoint = {line['postcode']: line['rows'] for line in map(json.loads, f)}
+    assert checkpoint == {'PAGED': ROWS['PAGED'], 'BAD': [], 'EMPTY': [], 'FLAKY': ROWS['FLAKY']}
+
+    certificates = EPCHarvester('token', CHECKPOINT_PATH).load()
+    assert sorted(certificates['lmk-key']) == sorted(row['lmk-key'] for row in ROWS['PAGED'] + ROWS['FLAKY'])
+
+
+def test_resume_from_checkpoint(tmp_path):
+    "Postcodes already in the checkpoint are not requested again, and a cut off last line is ignored"
+    CHECKPOINT_PATH = str(tmp_path / 'checkpoint.jsonl')
+    asyncio.run(harvest(stub_app()[0], CHECKPOINT_PATH, ['PAGED']))
+    with open(CHECKPOINT_PATH, 'a') as f:
+        f.write('{"postcode": "EMPTY", "ro')
+
+    app, requests = stub_app()
+    asyncio.run(harvest(app, CHECKPOINT_PATH, ['PAGED', 'EMPTY', 'FLAKY']))
+
+    assert requests == {'EMPTY': 1, 'FLAKY': 3}
+    assert len(EPCHarvester('token', CHECKPOINT_PATH).load()) == len(ROWS['PAGED']) + len(ROWS['FLAKY'])
+
+
+def test_server_errors_stop_after_retries(tmp_path):
+    "A postcode failing with 5xx on every retry stops the harvest and is not checkpointed"
+    CHECKPOINT_PATH = str(tmp_path / 'checkpoint.jsonl')
+    app, requests = stub_app()
+    with pytest.raises(aiohttp.ClientResponseError) as error:
+        asyncio.run(harvest(app, CHECKPOINT_PATH, ['DOWN'], retries=2))
+
+    assert error.value.status == 500
+    assert requests == {'DOWN': 3}
+    assert EPCHarvester('token', CHECKPOINT_PATH).done_postcodes() == set()
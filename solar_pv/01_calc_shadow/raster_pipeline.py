@@ -0,0 +1,302 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import rasterio
+import rasterio.transform
+from rasterio import features
+from shapely.geometry import shape
+from scipy import ndimage
+import time
+
+# Reclass bins (lower, upper] and classes, matching the tables used with native:reclassifybytable
+SLOPE_BINS = [0, 20, 40, 60]                                     # degrees
+SLOPE_CLASSES = [0, 1, 2, 3, 4]
+ASPECT_BINS = [0, 0.78539816339, 2.35619, 3.92699, 5.49779, 6.28319] # radians
+ASPECT_CLASSES = [0, 1, 2, 3, 4, 1, 1]
+
+def read_raster(path):
+    """
+    Read first band of a raster with nodata as nan.
+
+    Input
+    path(str): Path to raster layer
+
+    Output
+    array(array): Values (float32)
+    profile(dict): Rasterio profile with transform and crs
+    """
+    with rasterio.open(path) as src:
+        array = src.read(1).astype(np.float32)
+        if src.nodata is not None:
+            array[array == src.nodata] = np.nan
+        profile = src.profile
+
+    return array, profile
+
+def write_raster(path, array, profile, nodata=-9999):
+    """
+    Write array as a single band float32 GeoTIFF.
+
+    Input
+    path(str): Output path
+    array(array): Values, nan written as nodata
+    profile(dict): Rasterio profile of the source raster
+    nodata(float): Nodata value
+    """
+    profile = dict(profile, driver='GTiff', dtype='float32', count=1, nodata=nodata)
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(np.where(np.isnan(array), nodata, array).astype(np.float32), 1)
+
+def slope_aspect(dsm, xres, yres):
+    """
+    Slope and aspect from Horn's 3x3 finite differences, as gdal:slope and native:aspect.
+    Edge cells and flat cells (aspect only) are nan.
+
+    Input
+    dsm(array): Heights in meters
+    xres(float): Pixel width in meters
+    yres(float): Pixel height in meters
+
+    Output
+    slope(array): Degrees from horizontal
+    aspect(array): Radians clockwise from north of the downslope direction
+    """
+    z = np.pad(dsm, 1, constant_values=np.nan)
+    a, b, c = z[:-2, :-2], z[:-2, 1:-1], z[:-2, 2:]
+    d, f = z[1:-1, :-2], z[1:-1, 2:]
+    g, h, i = z[2:, :-2], z[2:, 1:-1], z[2:, 2:]
+
+    dz_east = ((c + 2 * f + i) - (a + 2 * d + g)) / (8 * xres)
+    dz_north = ((a + 2 * b + c) - (g + 2 * h + i)) / (8 * yres)
+
+    slope = np.degrees(np.arctan(np.hypot(dz_east, dz_north)))
+    aspect = np.arctan2(-dz_east, -dz_north) % (2 * np.pi)
+    aspect[(dz_east == 0) & (dz_north == 0)] = np.nan
+
+    return slope.astype(np.float32), aspect.astype(np.float32)
+
+def reclassify(array, bins, classes):
+    """
+    Classify values into (lower, upper] bins with np.digitize.
+
+    Input
+    array(array): Values, nan where missing
+    bins(list): Increasing bin edges
+    classes(list): Class of each np.digitize index (len(bins) + 1)
+
+    Output
+    (array): Classes, -1 where missing (int32)
+    """
+    index = np.digitize(np.nan_to_num(array, nan=-np.inf), bins, right=True)
+    return np.where(np.isnan(array), -1, np.asarray(classes)[index]).astype(np.int32)
+
+def sieve(classes, threshold):
+    """
+    Replace 4-connected regions smaller than threshold pixels with the class of their
+    largest neighbouring region, as gdal:sieve. Missing cells (-1) are left untouched.
+
+    Input
+    classes(array): Classes, -1 where missing
+    threshold(int): Minimum region size in pixels
+
+    Output
+    (array): Sieved classes
+    """
+    valid = classes >= 0
+    labels = np.zeros(classes.shape, dtype=np.int64)
+    n_labels = 0
+    for value in np.unique(classes[valid]):
+        region, count = ndimage.label(classes == value)
+        labels[region > 0] = region[region > 0] + n_labels
+        n_labels += count
+
+    sizes = np.bincount(labels.ravel(), minlength=n_labels + 1)
+    region_class = np.full(n_labels + 1, -1, dtype=classes.dtype)
+    region_class[labels[valid]] = classes[valid]
+
+    # Pairs of 4-adjacent pixels in different regions
+    a = np.concatenate([labels[:, :-1].ravel(), labels[:-1, :].ravel()])
+    b = np.concatenate([labels[:, 1:].ravel(), labels[1:, :].ravel()])
+    keep = (a != b) & (a > 0) & (b > 0)
+    a, b = np.concatenate([a[keep], b[keep]]), np.concatenate([b[keep], a[keep]])
+
+    # Largest neighbour of each small region
+    small = sizes[a] < threshold
+    a, b = a[small], b[small]
+    order = np.lexsort((-sizes[b], a))
+    a, b = a[order], b[order]
+    first = np.r_[True, a[1:] != a[:-1]] if len(a) else np.zeros(0, dtype=bool)
+
+    target = np.arange(n_labels + 1)
+    target[a[first]] = b[first]
+
+    return np.where(valid, region_class[target[labels]], classes)
+
+def polygonize(classes, transform, crs):
+    """
+    Vector polygons of 4-connected regions with the same class.
+
+    Input
+    classes(array): Classes, -1 where missing
+    transform(Affine): Raster transform
+    crs: Raster crs
+
+    Output
+    (GeoDataFrame): Polygons with 'code' column
+    """
+    shapes = features.shapes(classes, mask=classes >= 0, connectivity=4, transform=transform)
+    geometries, codes = [], []
+    for geometry, value in shapes:
+        geometries.append(shape(geometry))
+        codes.append(int(value))
+
+    return gpd.GeoDataFrame({'code': codes}, geometry=geometries, crs=crs)
+
+def zonal_stats(polygons, rasters, transform, stats=['mean', 'min', 'max', 'count']):
+    """
+    Zonal statistics of any number of co-registered rasters for each polygon in one pass.
+    Polygons are rasterized once into a label array (pixel centres inside the polygon,
+    later polygons win where they overlap) and statistics come from bincount over the labels.
+
+    Input
+    polygons(GeoDataFrame): Zones in the raster crs
+    rasters(dict): Column prefix and array of each raster, nan where missing
+    transform(Affine): Raster transform shared by all rasters
+    stats(list): Any of 'mean', 'min', 'max', 'count'
+
+    Output
+    (DataFrame): One row per polygon (same order) with '{prefix}_{stat}' columns
+    """
+    print(f"Computing zonal statistics {list(rasters)}...")
+    start = time.time()
+
+    n_zones = len(polygons)
+    shape_ = next(iter(rasters.values())).shape
+    labels = features.rasterize(
+        ((geometry, i + 1) for i, geometry in enumerate(polygons.geometry) if geometry is not None and not geometry.is_empty),
+        out_shape=shape_, transform=transform, fill=0, dtype=np.int32
+    )
+
+    table = {}
+    for prefix, array in rasters.items():
+        valid = (labels > 0) & ~np.isnan(array)
+        zone, values = labels[valid], array[valid].astype(np.float64)
+        count = np.bincount(zone, minlength=n_zones + 1)[1:]
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if 'mean' in stats:
+                table[f'{prefix}_mean'] = np.bincount(zone, weights=values, minlength=n_zones + 1)[1:] / count
+        if 'min' in stats or 'max' in stats:
+            # Sort by zone then value, first and last of each zone are its min and max
+            order = np.lexsort((values, zone))
+            zone, values = zone[order], values[order]
+            first = np.r_[True, zone[1:] != zone[:-1]] if len(zone) else np.zeros(0, dtype=bool)
+            last = np.r_[zone[1:] != zone[:-1], True] if len(zone) else np.zeros(0, dtype=bool)
+            if 'min' in stats:
+                table[f'{prefix}_min'] = np.full(n_zones, np.nan)
+                table[f'{prefix}_min'][zone[first] - 1] = values[first]
+            if 'max' in stats:
+                table[f'{prefix}_max'] = np.full(n_zones, np.nan)
+                table[f'{prefix}_max'][zone[last] - 1] = values[last]
+        if 'count' in stats:
+            table[f'{prefix}_count'] = count
+
+    end = time.time()
+    print(f"Computed zonal statistics in {end-start}s")
+
+    return pd.DataFrame(table)
+
+def rasterize_heights(footprints, column, bounds, resolution=0.5, fill=np.nan):
+    """
+    Burn a height attribute of footprints into a grid, as gdal:rasterize with a fixed extent and resolution.
+    Later footprints win where they overlap and cells outside footprints are set to fill.
+
+    Input
+    footprints(GeoDataFrame): Polygons with a height column
+    column(str): Height column to burn
+    bounds(tuple): (xmin, ymin, xmax, ymax) of the grid in the footprint crs
+    resolution(float): Pixel size in meters
+    fill(float): Value of cells outside footprints
+
+    Output
+    heights(array): Heights (float32)
+    transform(Affine): Grid transform
+    """
+    xmin, ymin, xmax, ymax = bounds
+    shape_ = (max(1, int(np.ceil((ymax - ymin) / resolution))), max(1, int(np.ceil((xmax - xmin) / resolution))))
+    transform = rasterio.transform.from_origin(xmin, ymax, resolution, resolution)
+
+    valid = footprints[footprints.geometry.notna() & footprints[column].notna()]
+    heights = features.rasterize(
+        zip(valid.geometry, valid[column].astype(np.float32)),
+        out_shape=shape_, transform=transform, fill=fill, dtype=np.float32
+    ) if len(valid) else np.full(shape_, fill, dtype=np.float32)
+
+    return heights, transform
+
+def segment_roofs(DSM_path, houses, TEMP_PATH, slope_threshold=12, aspect_threshold=2):
+    """
+    Roof planes from a DSM in memory: slope and aspect -> reclass -> sieve -> clip to houses
+    -> polygonize combined slope/aspect classes once -> buffer.
+    Polygons of the combined classes are the intersection of slope and aspect polygons.
+
+    Input
+    DSM_path(str): Path to DSM raster layer (.tif)
+    houses(GeoDataFrame): Building footprints in the DSM crs
+    TEMP_PATH(str): Folder for slope, aspect and roof segment outputs
+    slope_threshold(int): Sieve threshold for slope classes in pixels
+    aspect_threshold(int): Sieve threshold for aspect classes in pixels
+
+    Output
+    (dict): Paths to 'roof_segments', 'slope' and 'aspect' and 'timings' of each stage in seconds
+    """
+    timings = {}
+    start = time.time()
+
+    dsm, profile = read_raster(DSM_path)
+    transform = profile['transform']
+    timings['read'] = time.time() - start
+
+    start = time.time()
+    slope, aspect = slope_aspect(dsm, abs(transform.a), abs(transform.e))
+    timings['slope_aspect'] = time.time() - start
+
+    start = time.time()
+    slope_class = sieve(reclassify(slope, SLOPE_BINS, SLOPE_CLASSES), slope_threshold)
+    aspect_class = sieve(reclassify(aspect, ASPECT_BINS, ASPECT_CLASSES), aspect_threshold)
+    timings['reclass_sieve'] = time.time() - start
+
+    start = time.time()
+    inside = features.geometry_mask(houses.geometry, dsm.shape, transform, invert=True)
+    code = np.where(inside & (slope_class >= 0) & (aspect_class >= 0), slope_class * 10 + aspect_class, -1).astype(np.int32)
+    timings['clip'] = time.time() - start
+
+    start = time.time()
+    segments = polygonize(code, transform, profile['crs'])
+    segments['slope'] = segments['code'] // 10
+    segments['aspect'] = segments['code'] % 10
+    segments = segments.drop(columns=['code'])
+    timings['polygonize'] = time.time() - start
+
+    start = time.time()
+    for distance in [-0.8, 0.8, 1, -2]:
+        segments['geometry'] = segments.buffer(distance, resolution=5, cap_style=2, join_style=1)
+    segments = segments[~segments.is_empty].reset_index(drop=True)
+    segments['fid'] = np.arange(1, len(segments) + 1)
+    timings['buffer'] = time.time() - start
+
+    start = time.time()
+    paths = {
+        'roof_segments': TEMP_PATH + 'roof_segments.geojson',
+        'slope': TEMP_PATH + 'slope.tif',
+        'aspect': TEMP_PATH + 'aspect.tif'
+    }
+    segments.to_file(paths['roof_segments'], driver='GeoJSON')
+    write_raster(paths['slope'], slope, profile)
+    write_raster(paths['aspect'], aspect, profile)
+    timings['write'] = time.time() - start
+
+    for stage, seconds in timings.items():
+        print(f"{stage}: {seconds:.2f}s")
+
+    return dict(paths, timings=timings)
@@ -22,7 +22,7 @@ from processing.core.Processing import Processing
 Processing.initialize()
 
 import processing
-from osgeo import gdal
+from osgeo import gdal, osr
 from osgeo.gdalconst import *
 from qgis.analysis import QgsRasterCalculator, QgsRasterCalculatorEntry
 
@@ -32,17 +32,35 @@ import os
 from pathlib import Path
 import time
 import pickle
+import datetime
+import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+import shadow_engine
+import raster_pipeline
+
+# Days sampled for shading
+SHADING_DATES = {
+    'spring': datetime.date(2022, 9, 23),
+    'winter': datetime.date(2022, 12, 21),
+    'summer': datetime.date(2022, 6, 21),
+    'fall': datetime.date(2022, 3, 20)
+}
 
 class CalculateShading():
     """
     Compute attributes (shading, slope, aspect, area) to calculate solar pv output.
     """
-    def __init__(self, DSM_PATH, HOUSE_SHP_PATH=None, crs='EPSG:27700'):
+    def __init__(self, DSM_PATH, HOUSE_SHP_PATH=None, crs='EPSG:27700', TEMP_PATH=None, block_size=None):
         self.PROJECT_CRS = QgsCoordinateReferenceSystem(crs)
+        self.block_size = block_size
         self.ROOT_DIR = os.getcwd() + "//"
-        if not os.path.isdir(self.ROOT_DIR + "temp//"):
-            os.makedirs(self.ROOT_DIR + "temp//")
-        self.TEMP_PATH = self.ROOT_DIR + "temp//"
+        self.TEMP_PATH = TEMP_PATH if TEMP_PATH else self.ROOT_DIR + "temp//"
+        if not os.path.isdir(self.TEMP_PATH):
+            os.makedirs(self.TEMP_PATH)
         self.clear_temp_folder()
 
         self.tile_name = Path(DSM_PATH).stem
@@ -50,6 +68,7 @@ class CalculateShading():
         
         self.DSM_path = self.convert_DSM_to_tif(DSM_PATH)
         self.extent = self.get_extent(self.DSM_path)
+        self.HOUSE_SRC_PATH = HOUSE_SHP_PATH
         self.HOUSE_SHP_PATH = self.clip_polygon(HOUSE_SHP_PATH, self.extent)
 
     def convert_DSM_to_tif(self, layer):
@@ -514,6 +533,25 @@ class CalculateShading():
 
         return output['OUTPUT']
 
+    def calculate_area_in_memory(self, segments):
+        """
+        Calculate sloped area of each roof segment and save in roof_segments_unfiltered.
+
+        Input:
+        segments(GeoDataFrame): Roof segments with slope_mean
+
+        Output:
+        (str): Path to vector layer with added AREA attribute
+        """
+        OUTPUT_DIR = self.ROOT_DIR + 'output//roof_segments_unfiltered//'
+        if not os.path.isdir(OUTPUT_DIR):
+            os.makedirs(OUTPUT_DIR)
+
+        segments['AREA'] = segments.area / np.cos(np.radians(segments['slope_mean']))
+        segments.to_file(OUTPUT_DIR + self.tile_name + '.geojson', driver='GeoJSON')
+
+        return OUTPUT_DIR + self.tile_name + '.geojson'
+
     def filter_polygons(self, layer):
         """
         Filter polygons for area > 5m^2, slope betweeon 0-60 degrees and aspect between 67.5 and 292.5
@@ -540,13 +578,17 @@ class CalculateShading():
 
         return output['OUTPUT']
 
-    def calculate_shading(self, layer, mask, UTC=1):
+    def calculate_shading(self, layer, mask, UTC=1, dates=None, itertime=120, tolerance=1.0):
         """
-        Get average shading for spring (20/3/2022) and fall (23/9/2022) equinoxes.
+        Get average shading for spring (20/3/2022) and fall (23/9/2022) equinoxes and summer and winter solstices.
 
         Input:
         layer(str): Path to DSM raster layer
+        mask(str): Path to polygon vector layer
         UTC(int): Timezone in UTC default to UK
+        dates(dict): Name and datetime.date of days to sample, defaults to SHADING_DATES
+        itertime(int): Minutes between sun positions
+        tolerance(float): Angle in degrees within which sun positions are merged, 0 to shade every position
         
         Output:
         (str): Path to vector layer with total shading (0-1) of each roof segment
@@ -554,94 +596,126 @@ class CalculateShading():
         print("Calcuating average shading...")
         start = time.time()
 
-        baseraster = gdal.Open(layer)
-        fillraster = baseraster.ReadAsArray().astype(float)
-        fillraster = fillraster * 0.0
-        
-        index = 0
-        
-        if not os.path.isdir(self.TEMP_PATH + 'shading//'):
-            os.makedirs(self.TEMP_PATH + 'shading//')
-
-        dates_dict = {
-            'spring': QDate.fromString("23-9-2022", "d-M-yyyy"),
-            'winter': QDate.fromString("21-12-2022", "d-M-yyyy"),
-            'summer': QDate.fromString("21-6-2022", "d-M-yyyy"),
-            'fall': QDate.fromString("20-3-2022", "d-M-yyyy")
-        }
+        shadow_path = self.shadow_raster(layer, UTC, dates, itertime, tolerance)
+        output = self.zonal_statistics(shadow_path, mask, 'shading')
 
-        for name, date in dates_dict.items():
-            print(f"Shading {name}...")
-            shading_params = {
-                'INPUT_DSM':layer,
-                'INPUT_CDSM':None,
-                'TRANS_VEG':3,
-                'INPUT_TDSM':None,
-                'INPUT_THEIGHT':25,
-                'INPUT_HEIGHT':None,
-                'INPUT_ASPECT':None,
-                'UTC':UTC,
-                'DST':False,
-                'DATEINI':date,
-                'ITERTIME':120,
-                'ONE_SHADOW':False,
-                'TIMEINI':QTime(12, 46, 56),
-                'OUTPUT_DIR': self.TEMP_PATH + 'shading//'
-                }
-            
-            output = processing.run("umep:Solar Radiation: Shadow Generator", shading_params)
+        end = time.time()
+        print(f"Completed calculating average shading in {end-start}s")
+        return output
 
-            print(f"Shaded for {name}")
+    def shadow_raster(self, layer, UTC=1, dates=None, itertime=120, tolerance=1.0, block_size=None):
+        """
+        Average sunlit fraction (0-1) of each DSM pixel saved as Shadow_Aggregated.tif.
+        Shadows are cast in memory by shadow_engine and averaged over sun positions every itertime minutes,
+        positions within tolerance degrees of each other are shaded once and weighted.
 
-            no_of_files = os.listdir(self.TEMP_PATH + 'shading//')
+        Input:
+        layer(str): Path to DSM raster layer
+        UTC(int): Timezone in UTC default to UK
+        dates(dict): Name and datetime.date of days to sample, defaults to SHADING_DATES
+        itertime(int): Minutes between sun positions
+        tolerance(float): Angle in degrees within which sun positions are merged, 0 to shade every position
+        block_size(int): Shade in blocks of this many pixels to bound memory, defaults to self.block_size (None shades the whole tile)
 
-            for j in range(0, no_of_files.__len__()):
-                tempgdal = gdal.Open(self.TEMP_PATH + 'shading//' + no_of_files[j])
-                tempraster = tempgdal.ReadAsArray().astype(float)
-                fillraster = fillraster + tempraster
-                tempgdal = None
-                os.remove(self.TEMP_PATH + 'shading//' + no_of_files[j])
+        Output:
+        (str): Path to shadow raster layer
+        """
+        baseraster = gdal.Open(layer)
+        band = baseraster.GetRasterBand(1)
+        nodata = band.GetNoDataValue()
+
+        def read(row0=0, row1=baseraster.RasterYSize, col0=0, col1=baseraster.RasterXSize):
+            dsm = band.ReadAsArray(col0, row0, col1 - col0, row1 - row0).astype(np.float32)
+            if nodata is not None:
+                dsm[dsm == nodata] = np.nan
+            return dsm
+
+        if dates is None:
+            dates = SHADING_DATES
+        if block_size is None:
+            block_size = self.block_size
+
+        lat, lon = self.get_centre_latlon(baseraster)
+        azimuth, elevation, weights = shadow_engine.plan_sun_samples(dates.values(), lat, lon, UTC, itertime, tolerance)
+
+        scale = abs(baseraster.GetGeoTransform()[1])
+        if block_size is None:
+            fillraster = shadow_engine.aggregate_shadows(read(), scale, azimuth, elevation, weights)
+            
+            print("Saving raster...")
+            self.saveraster(baseraster, self.TEMP_PATH + 'Shadow_Aggregated.tif', fillraster)
+        else:
+            outDs = self.saveraster(baseraster, self.TEMP_PATH + 'Shadow_Aggregated.tif')
+            outBand = outDs.GetRasterBand(1)
+            height_min, height_max = band.ComputeRasterMinMax(False)
+            shape = (baseraster.RasterYSize, baseraster.RasterXSize)
+            shadow_engine.aggregate_shadows_windowed(
+                read, lambda row0, col0, array: outBand.WriteArray(array, col0, row0),
+                shape, scale, height_max - height_min, azimuth, elevation, weights, block_size
+            )
+            outBand.FlushCache()
+            outDs = None
+
+        return self.TEMP_PATH + 'Shadow_Aggregated.tif'
+
+    def get_centre_latlon(self, gdal_data):
+        """
+        Latitude and longitude of the centre of a raster.
 
-                index = index + 1 #A counter that specifies total numer of shadows in a year (2 hour resolution)
+        Input
+        gdal_data(gdal Dataset): Raster layer
 
-        fillraster = fillraster / index
-        
-        print("Saving raster...")
-        self.saveraster(baseraster, self.TEMP_PATH + 'Shadow_Aggregated.tif', fillraster)
+        Output
+        (tuple): Latitude and longitude in degrees
+        """
+        geotransform = gdal_data.GetGeoTransform()
+        x = geotransform[0] + geotransform[1] * gdal_data.RasterXSize / 2
+        y = geotransform[3] + geotransform[5] * gdal_data.RasterYSize / 2
 
-        output = self.zonal_statistics(self.TEMP_PATH + 'Shadow_Aggregated.tif', mask, 'shading')
+        source = osr.SpatialReference()
+        source.ImportFromWkt(gdal_data.GetProjection())
+        target = osr.SpatialReference()
+        target.ImportFromEPSG(4326)
+        source.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        target.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
 
-        end = time.time()
-        print(f"Completed calculating average shading in {end-start}s")
-        return output
+        lon, lat, _ = osr.CoordinateTransformation(source, target).TransformPoint(x, y)
+        return lat, lon
 
-    def saveraster(self, gdal_data, filename, raster):
+    def saveraster(self, gdal_data, filename, raster=None):
         rows = gdal_data.RasterYSize
         cols = gdal_data.RasterXSize
 
         outDs = gdal.GetDriverByName("GTiff").Create(filename, cols, rows, int(1), GDT_Float32)
         outBand = outDs.GetRasterBand(1)
-
-        # write the data
-        outBand.WriteArray(raster, 0, 0)
-        # flush data to disk, set the NoData value and calculate stats
-        outBand.FlushCache()
         outBand.SetNoDataValue(-9999)
 
         # georeference the  image and set the projection
         outDs.SetGeoTransform(gdal_data.GetGeoTransform())
         outDs.SetProjection(gdal_data.GetProjection())
 
-    def roof_segmentation(self):
+        # without a raster the open dataset is returned to be written block by block
+        if raster is None:
+            return outDs
+
+        # write the data and flush data to disk
+        outBand.WriteArray(raster, 0, 0)
+        outBand.FlushCache()
+
+    def roof_segmentation(self, in_memory=True):
         """
         Convert DSM (.asc) to (.tif) -> Calculate slope and aspect -> Merge pixels with same slope and aspect as a roof segment
 
         Input:
         DSM(str): Path to DSM (.asc/.tif)
+        in_memory(bool): Run the NumPy pipeline in raster_pipeline instead of chained processing algorithms
 
         Output:
         (str): Path to vector layer with segmented roofs.
         """
+        if in_memory:
+            return self.roof_segmentation_in_memory()
+
         print("Perfoming roof segmentation...")
 
         self.slope_path = self.calculate_slope(self.DSM_path)
@@ -682,6 +756,28 @@ class CalculateShading():
         print("Completed roof segmentation.")
         return buffer_path
     
+    def roof_segmentation_in_memory(self):
+        """
+        Roof segmentation with the DSM kept in memory, see raster_pipeline.segment_roofs.
+        Slope and aspect rasters are written once for the zonal statistics.
+
+        Output:
+        (str): Path to vector layer with segmented roofs.
+        """
+        print("Perfoming roof segmentation in memory...")
+        start = time.time()
+
+        houses = gpd.read_file(self.HOUSE_SRC_PATH)
+        houses = houses.to_crs(self.PROJECT_CRS.authid())
+
+        output = raster_pipeline.segment_roofs(self.DSM_path, houses, self.TEMP_PATH)
+        self.slope_path = output['slope']
+        self.aspect_path = output['aspect']
+
+        end = time.time()
+        print(f"Completed roof segmentation in {end-start}s")
+        return output['roof_segments']
+    
     def filter_roof_segments(self, layer):
         """
         Filter roof segments for slope, area and shading.
@@ -696,20 +792,19 @@ class CalculateShading():
         print("Filtering houses...")
         start = time.time()
         
-        # Calculate stats
-        slope_stats = self.zonal_statistics(self.slope_path, layer, 'slope')
-        aspect_stats = self.zonal_statistics(self.aspect_path, layer, 'aspect')
-        height_stats = self.zonal_statistics(self.DSM_path, layer, 'height')
-        shading_stats = self.calculate_shading(self.DSM_path, layer)
-    
-        # Get final merged layer
-        slope_aspect_merge = self.merge_vector_layers(slope_stats, aspect_stats, ['aspect_mean'])        
-        height_merge = self.merge_vector_layers(slope_aspect_merge, height_stats, ['height_mean'])
-        merged = self.merge_vector_layers(height_merge, shading_stats, ['shading_mean'])
-        area = self.calculate_area(merged)
+        # Calculate stats for all rasters in one pass
+        shadow_path = self.shadow_raster(self.DSM_path)
+        rasters = {}
+        for prefix, path in [('slope', self.slope_path), ('aspect', self.aspect_path), ('height', self.DSM_path), ('shading', shadow_path)]:
+            rasters[prefix], profile = raster_pipeline.read_raster(path)
+
+        segments = gpd.read_file(layer)
+        stats = raster_pipeline.zonal_stats(segments, rasters, profile['transform'], stats=['mean'])
+        merged = pd.concat([segments.reset_index(drop=True), stats], axis=1)
+        area = self.calculate_area_in_memory(merged)
 
         # Add uprn
-        final_layer = self.add_uprn(filtered)
+        final_layer = self.add_uprn(area)
 
         # Filter layers
         filtered = self.filter_polygons(final_layer)
@@ -765,7 +860,77 @@ class CalculateShading():
 
         return output['OUTPUT']
 
-def main():
+def process_tile(DSM_PATH, HOUSE_SHP_PATH, block_size=None):
+    """
+    Roof segmentation and filtering for one DSM tile in its own scratch folder.
+
+    Input
+    DSM_PATH(str): Path to DSM (.asc)
+    HOUSE_SHP_PATH(str): Path to building footprints of the tile
+    block_size(int): Shade in blocks of this many pixels, None shades the whole tile
+
+    Output
+    (float): Seconds taken
+    """
+    start = time.time()
+
+    TEMP_PATH = os.getcwd() + "//temp//" + Path(DSM_PATH).stem + "//"
+    program = CalculateShading(DSM_PATH, HOUSE_SHP_PATH, TEMP_PATH=TEMP_PATH, block_size=block_size)
+    segmented_layer = program.roof_segmentation()
+    program.filter_roof_segments(segmented_layer)
+    shutil.rmtree(TEMP_PATH, ignore_errors=True)
+
+    return time.time() - start
+
+def load_manifest(MANIFEST_PATH):
+    "Load per-tile status, empty if no run has started"
+    if not os.path.isfile(MANIFEST_PATH):
+        return {}
+    with open(MANIFEST_PATH, 'r') as f:
+        return json.load(f)
+
+def save_manifest(MANIFEST_PATH, manifest):
+    "Save per-tile status, via a temporary file so a crash never leaves a truncated manifest"
+    with open(MANIFEST_PATH + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(MANIFEST_PATH + '.tmp', MANIFEST_PATH)
+
+def run_tiles(tiles, MANIFEST_PATH, workers=None, block_size=None):
+    """
+    Process DSM tiles in a worker pool, recording the status of each tile in a manifest.
+    Tiles marked 'done' are skipped so a crashed run resumes where it stopped.
+
+    Input
+    tiles(list): (DSM_PATH, HOUSE_SHP_PATH) of each tile
+    MANIFEST_PATH(str): Path to manifest (.json)
+    workers(int): Number of worker processes, defaults to number of cores
+    block_size(int): Shade in blocks of this many pixels, None shades whole tiles
+    """
+    manifest = load_manifest(MANIFEST_PATH)
+    todo = [(dsm, house) for dsm, house in tiles if manifest.get(Path(dsm).stem, {}).get('status') != 'done']
+    print(f"Processing {len(todo)} tiles, skipping {len(tiles) - len(todo)} already done...")
+
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = {}
+        for DSM_PATH, HOUSE_SHP_PATH in todo:
+            futures[executor.submit(process_tile, DSM_PATH, HOUSE_SHP_PATH, block_size)] = Path(DSM_PATH).stem
+            manifest[Path(DSM_PATH).stem] = {'status': 'running', 'dsm': DSM_PATH, 'house': HOUSE_SHP_PATH}
+        save_manifest(MANIFEST_PATH, manifest)
+
+        for future in as_completed(futures):
+            tile_name = futures[future]
+            try:
+                manifest[tile_name].update({'status': 'done', 'seconds': future.result()})
+                print(f"Completed tile {tile_name}")
+            except Exception as e:
+                manifest[tile_name].update({'status': 'failed', 'error': repr(e)})
+                print(f"Failed tile {tile_name}: {e!r}")
+            save_manifest(MANIFEST_PATH, manifest)
+
+    failed = [name for name, entry in manifest.items() if entry['status'] != 'done']
+    print(f"Completed {len(manifest) - len(failed)} tiles, {len(failed)} failed: {failed}")
+
+def main(workers=None, block_size=None):
     with open('/../00_compare_grid/os_mapping.pkl', 'rb') as f:
         os_mapping = pickle.load(f)
     
@@ -777,16 +942,20 @@ def main():
     house_files = glob(HOUSE_DIR + "*.geojson")
     house_files = [path.replace('\\', '/') for path in house_files]
 
+    tiles = []
     for DSM_PATH in DSM_files:
         tile_name = Path(DSM_PATH).stem.split('_')[0].upper()
         HOUSE_SHP_PATH = HOUSE_DIR + os_mapping[tile_name] + '.geojson'
         print(HOUSE_SHP_PATH)
 
         if HOUSE_SHP_PATH in house_files:
-            program = CalculateShading(DSM_PATH, HOUSE_SHP_PATH)
-            segmented_layer = program.roof_segmentation()
-            filtered_layer = program.filter_roof_segments(segmented_layer)
-   
+            tiles.append((DSM_PATH, HOUSE_SHP_PATH))
+
+    OUTPUT_DIR = os.getcwd() + '//output//'
+    if not os.path.isdir(OUTPUT_DIR):
+        os.makedirs(OUTPUT_DIR)
+    run_tiles(tiles, OUTPUT_DIR + 'shading_manifest.json', workers, block_size)
+    
     
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -26,13 +26,24 @@ from osgeo import gdal
 from osgeo.gdalconst import *
 
 import pandas as pd
+import numpy as np
+import geopandas as gpd
+from shapely.geometry import box
 from glob import glob
 import shutil
 import os
 from pathlib import Path
 import time
 
-from shading_with_DSM import CalculateShading
+from shading_with_DSM import CalculateShading, SHADING_DATES
+import shadow_engine
+import raster_pipeline
+
+sys.path.append('../../processing_data')
+from os_cache import GMLCache
+
+# Columns of the OS building height attribute csv
+BUILDING_HEIGHT_COLUMNS = ['fid','OS_TOPO_TOID_VERSION','BHA_ProcessDate','TileRef', 'AbsHMin', 'AbsH2','AbsHMax','RelH2','RelHMax','BHA_Conf']
 
 class ApproximateShading(CalculateShading):
     def __init__(self, HOUSE_SHP_PATH, crs='EPSG:27700'):
@@ -49,25 +60,29 @@ class ApproximateShading(CalculateShading):
         self.tile_name = Path(HOUSE_SHP_PATH).stem
         print(self.tile_name)     
         
-    def build_pseudo_DSM(self, building_height, topology_area):
+    def build_pseudo_DSM(self, building_height, topology_area, in_memory=True):
         """
         Create pseudo-DSM from building height.
 
         Input
         building_height(str): Path to building height attribute file
         topology_area(str): Path to topology area file
+        in_memory(bool): Join and rasterize in memory instead of chained processing algorithms
 
         Output
-        (str): Path to pseudo-DSM
+        (str/array): Path to pseudo-DSM, or heights when in_memory
         
         """
+        if in_memory:
+            return self.build_pseudo_DSM_in_memory(building_height, topology_area)
+
         print("Building pseudo DSM...")
         start = time.time()
 
         building_df = pd.read_csv(
             building_height, 
             header=None,
-            names= ['fid','OS_TOPO_TOID_VERSION','BHA_ProcessDate','TileRef', 'AbsHMin', 'AbsH2','AbsHMax','RelH2','RelHMax','BHA_Conf'],
+            names=BUILDING_HEIGHT_COLUMNS,
             on_bad_lines='skip'
             )
         building_df.head()
@@ -104,6 +119,48 @@ class ApproximateShading(CalculateShading):
 
         return self.pseudo_DSM
     
+    def build_pseudo_DSM_in_memory(self, building_height, topology_area, resolution=0.5):
+        """
+        Create pseudo-DSM by joining building heights to footprints on fid in pandas and burning
+        AbsHMax into a grid over the house extent, without intermediate files.
+
+        Input
+        building_height(str): Path to building height attribute file
+        topology_area(str): Path to topology area file
+        resolution(float): Pixel size in meters
+
+        Output
+        (array): Pseudo-DSM heights, 0 outside buildings as the INIT value of the gdal:rasterize path
+        """
+        print("Building pseudo DSM in memory...")
+        start = time.time()
+
+        building_df = pd.read_csv(
+            building_height,
+            header=None,
+            names=BUILDING_HEIGHT_COLUMNS,
+            usecols=['fid', 'AbsHMax'],
+            dtype={'fid': str},
+            on_bad_lines='skip'
+            )
+        building_df['AbsHMax'] = pd.to_numeric(building_df['AbsHMax'], errors='coerce')
+
+        houses = gpd.read_file(self.HOUSE_SHP_PATH)
+        self.houses_crs = houses.crs
+        self.houses = houses.to_crs(self.PROJECT_CRS.authid())
+        bounds = tuple(self.houses.total_bounds)
+
+        # OS MasterMap GML layers converted once to GeoParquet, shared with processing_data
+        topo_df = GMLCache().read(topology_area, 'TopographicArea', columns=['fid'], bbox=bounds)
+        topo_df = topo_df.merge(building_df, on='fid', how='inner')
+
+        self.pseudo_DSM, self.pseudo_DSM_transform = raster_pipeline.rasterize_heights(topo_df, 'AbsHMax', bounds, resolution, fill=0)
+
+        end = time.time()
+        print(f"Completed building pseudo DSM of {len(topo_df)} buildings in {end-start}s")
+
+        return self.pseudo_DSM
+
     def extract_extent(self, layer):
         """
         Get and format extent from vector layer.
@@ -182,6 +239,9 @@ class ApproximateShading(CalculateShading):
         if not os.path.isdir(output_path):
             os.makedirs(output_path)
 
+        if isinstance(self.pseudo_DSM, np.ndarray):
+            return self.filter_houses_in_memory(output_path + f"{filename}.geojson")
+
         shading_stats = self.calculate_shading(self.pseudo_DSM, self.HOUSE_SHP_PATH)
         
         params = {
@@ -193,6 +253,42 @@ class ApproximateShading(CalculateShading):
         
         return output['OUTPUT']
 
+    def filter_houses_in_memory(self, output_path, UTC=1, dates=None, itertime=120, tolerance=1.0):
+        """
+        Cast shadows on the in-memory pseudo-DSM and average them over each house.
+
+        Input:
+        output_path(str): Path to output vector layer (.geojson)
+        UTC(int): Timezone in UTC default to UK
+        dates(dict): Name and datetime.date of days to sample, defaults to SHADING_DATES
+        itertime(int): Minutes between sun positions
+        tolerance(float): Angle in degrees within which sun positions are merged
+
+        Output:
+        (str): Path to vector layer with shading_mean
+        """
+        print("Calcuating average shading...")
+        start = time.time()
+
+        if dates is None:
+            dates = SHADING_DATES
+
+        centre = gpd.GeoSeries([box(*self.houses.total_bounds).centroid], crs=self.houses.crs).to_crs('EPSG:4326')
+        azimuth, elevation, weights = shadow_engine.plan_sun_samples(dates.values(), centre.y[0], centre.x[0], UTC, itertime, tolerance)
+
+        scale = abs(self.pseudo_DSM_transform.a)
+        shadow = shadow_engine.aggregate_shadows(self.pseudo_DSM, scale, azimuth, elevation, weights)
+        stats = raster_pipeline.zonal_stats(self.houses, {'shading': shadow}, self.pseudo_DSM_transform, stats=['mean'])
+
+        houses = pd.concat([self.houses.reset_index(drop=True), stats], axis=1)
+        fields = ['uprn','postcode','buildingNumber','thoroughfare','parentUPRN','calculatedAreaValue','AbsHMax','shading_mean']
+        houses = houses[[field for field in fields if field in houses.columns] + ['geometry']]
+        houses.to_crs(self.houses_crs).to_file(output_path, driver='GeoJSON')
+
+        end = time.time()
+        print(f"Completed calculating average shading in {end-start}s")
+        return output_path
+
 
 def main(): 
     TOPOLOGY_DIR = "../../data/external/topology/"
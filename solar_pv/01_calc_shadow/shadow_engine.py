@@ -0,0 +1,367 @@
+import numpy as np
+import datetime
+import warnings
+import time
+
+def solar_terms(times):
+    """
+    Solar declination and equation of time using the NOAA solar position equations.
+
+    Input
+    times(array): UTC timestamps (numpy datetime64)
+
+    Output
+    jd(array): Julian days
+    declination(array): Degrees
+    eq_time(array): Equation of time in minutes
+    """
+    rad, deg = np.radians, np.degrees
+
+    jd = np.asarray(times, dtype='datetime64[s]').astype(float) / 86400 + 2440587.5
+    jc = (jd - 2451545) / 36525
+
+    mean_long = (280.46646 + jc * (36000.76983 + jc * 0.0003032)) % 360
+    mean_anom = 357.52911 + jc * (35999.05029 - 0.0001537 * jc)
+    ecc = 0.016708634 - jc * (0.000042037 + 0.0000001267 * jc)
+    eq_ctr = (np.sin(rad(mean_anom)) * (1.914602 - jc * (0.004817 + 0.000014 * jc))
+              + np.sin(rad(2 * mean_anom)) * (0.019993 - 0.000101 * jc)
+              + np.sin(rad(3 * mean_anom)) * 0.000289)
+    app_long = mean_long + eq_ctr - 0.00569 - 0.00478 * np.sin(rad(125.04 - 1934.136 * jc))
+    mean_obliq = 23 + (26 + (21.448 - jc * (46.815 + jc * (0.00059 - jc * 0.001813))) / 60) / 60
+    obliq = mean_obliq + 0.00256 * np.cos(rad(125.04 - 1934.136 * jc))
+    declination = deg(np.arcsin(np.sin(rad(obliq)) * np.sin(rad(app_long))))
+
+    var_y = np.tan(rad(obliq / 2)) ** 2
+    eq_time = 4 * deg(var_y * np.sin(2 * rad(mean_long))
+                      - 2 * ecc * np.sin(rad(mean_anom))
+                      + 4 * ecc * var_y * np.sin(rad(mean_anom)) * np.cos(2 * rad(mean_long))
+                      - 0.5 * var_y ** 2 * np.sin(4 * rad(mean_long))
+                      - 1.25 * ecc ** 2 * np.sin(2 * rad(mean_anom)))
+
+    return jd, declination, eq_time
+
+def sun_position(times, lat, lon):
+    """
+    Solar azimuth and elevation using the NOAA solar position equations.
+
+    Input
+    times(array): UTC timestamps (numpy datetime64)
+    lat(float): Latitude in degrees
+    lon(float): Longitude in degrees, east positive
+
+    Output
+    azimuth(array): Degrees clockwise from north
+    elevation(array): Degrees above horizon
+    """
+    rad, deg = np.radians, np.degrees
+    jd, declination, eq_time = solar_terms(times)
+
+    minutes = ((jd + 0.5) % 1) * 1440
+    hour_angle = ((minutes + eq_time + 4 * lon) % 1440) / 4 - 180
+
+    cos_zenith = (np.sin(rad(lat)) * np.sin(rad(declination))
+                  + np.cos(rad(lat)) * np.cos(rad(declination)) * np.cos(rad(hour_angle)))
+    zenith = deg(np.arccos(np.clip(cos_zenith, -1, 1)))
+
+    cos_azimuth = ((np.sin(rad(lat)) * np.cos(rad(zenith)) - np.sin(rad(declination)))
+                   / (np.cos(rad(lat)) * np.sin(rad(zenith))))
+    azimuth = deg(np.arccos(np.clip(cos_azimuth, -1, 1)))
+    azimuth = np.where(hour_angle > 0, (azimuth + 180) % 360, (540 - azimuth) % 360)
+
+    return azimuth, 90 - zenith
+
+def sun_positions(dates, lat, lon, UTC=1, itertime=120, solar_time=True):
+    """
+    Sun positions above the horizon through each day at a fixed time step.
+
+    With solar_time the steps are taken from each day's solar noon, so days with a similar
+    declination (e.g. the equinoxes) give near-identical positions that merge_sun_positions
+    can join. Otherwise they are taken from local midnight, as sampled by the UMEP Shadow
+    Generator; the equation of time then offsets such days by up to ~4 degrees.
+
+    Input
+    dates(list): datetime.date of each day to sample
+    lat(float): Latitude in degrees
+    lon(float): Longitude in degrees
+    UTC(int): Timezone offset of local time
+    itertime(int): Minutes between samples
+    solar_time(bool): Sample on solar time instead of clock time
+
+    Output
+    azimuth(array): Degrees clockwise from north
+    elevation(array): Degrees above horizon
+    """
+    times = []
+    for date in dates:
+        midnight = np.datetime64(datetime.datetime(date.year, date.month, date.day))
+        if solar_time:
+            # Solar noon in UTC minutes, steps in both directions from it
+            eq_time = solar_terms(midnight + np.timedelta64(12, 'h'))[2]
+            noon = midnight + np.timedelta64(int(round((720 - 4 * lon - eq_time) * 60)), 's')
+            steps = np.arange(-(720 // itertime) * itertime, 720, itertime)
+            times.append(noon + steps.astype('timedelta64[m]'))
+        else:
+            start = midnight - np.timedelta64(UTC, 'h')
+            times.append(start + np.arange(0, 24 * 60, itertime).astype('timedelta64[m]'))
+
+    azimuth, elevation = sun_position(np.concatenate(times), lat, lon)
+    above = elevation > 0
+
+    return azimuth[above], elevation[above]
+
+def sun_vectors(azimuth, elevation):
+    """
+    Unit vectors (east, north, up) pointing to the sun.
+
+    Input
+    azimuth(array): Degrees clockwise from north
+    elevation(array): Degrees above horizon
+
+    Output
+    (array): Shape (positions, 3)
+    """
+    az, el = np.radians(azimuth), np.radians(elevation)
+    return np.stack([np.sin(az) * np.cos(el), np.cos(az) * np.cos(el), np.sin(el)], axis=-1)
+
+def merge_sun_positions(azimuth, elevation, tolerance=1.0):
+    """
+    Merge sun positions within an angular tolerance into weighted samples so each distinct
+    sun geometry is shaded once. Positions join the first sample whose seed is within the
+    tolerance, the sample direction is the mean of its members and its weight their count.
+
+    Input
+    azimuth(array): Degrees clockwise from north
+    elevation(array): Degrees above horizon
+    tolerance(float): Maximum angle in degrees between a position and its sample seed, 0 to keep all
+
+    Output
+    azimuth(array): Sample azimuths
+    elevation(array): Sample elevations
+    weights(array): Number of positions merged into each sample
+    """
+    vectors = sun_vectors(azimuth, elevation)
+    if tolerance <= 0 or len(vectors) == 0:
+        return np.asarray(azimuth), np.asarray(elevation), np.ones(len(vectors))
+
+    min_cos = np.cos(np.radians(tolerance))
+    seeds = np.empty_like(vectors)
+    assign = np.empty(len(vectors), dtype=int)
+    n_seeds = 0
+    for i, vector in enumerate(vectors):
+        if n_seeds:
+            cos = seeds[:n_seeds] @ vector
+            j = np.argmax(cos)
+            if cos[j] >= min_cos:
+                assign[i] = j
+                continue
+        seeds[n_seeds] = vector
+        assign[i] = n_seeds
+        n_seeds += 1
+
+    weights = np.bincount(assign, minlength=n_seeds).astype(float)
+    mean = np.stack([np.bincount(assign, weights=vectors[:, k], minlength=n_seeds) for k in range(3)], axis=-1)
+    mean /= np.linalg.norm(mean, axis=1, keepdims=True)
+
+    merged_azimuth = np.degrees(np.arctan2(mean[:, 0], mean[:, 1])) % 360
+    merged_elevation = np.degrees(np.arcsin(np.clip(mean[:, 2], -1, 1)))
+
+    return merged_azimuth, merged_elevation, weights
+
+def plan_sun_samples(dates, lat, lon, UTC=1, itertime=120, tolerance=1.0, solar_time=True):
+    """
+    Weighted sun positions to shade for a set of dates at a target temporal resolution.
+    Lower itertime and tolerance trade throughput for accuracy. Positions are sampled on
+    solar time so the equinox dates line up and merge; with the default dates this shades
+    18 samples instead of 23 at itertime=120 (36/47 at 60, 72/95 at 30).
+
+    Input
+    dates(list): datetime.date of each day to sample
+    lat(float): Latitude in degrees
+    lon(float): Longitude in degrees
+    UTC(int): Timezone offset of local time
+    itertime(int): Minutes between samples
+    tolerance(float): Angle in degrees within which positions are merged
+    solar_time(bool): Sample on solar time, False for the clock times of the UMEP Shadow Generator
+
+    Output
+    azimuth(array): Sample azimuths
+    elevation(array): Sample elevations
+    weights(array): Number of positions merged into each sample
+    """
+    azimuth, elevation = sun_positions(dates, lat, lon, UTC, itertime, solar_time)
+    merged_azimuth, merged_elevation, weights = merge_sun_positions(azimuth, elevation, tolerance)
+
+    saved = 1 - len(weights) / len(azimuth) if len(azimuth) else 0
+    print(f"Planned {len(weights)} ray-march passes for {len(azimuth)} sun positions, {saved:.0%} fewer (tolerance {tolerance} degrees)")
+    return merged_azimuth, merged_elevation, weights
+
+def shift(array, drow, dcol, fill):
+    """
+    Shifted copy of a 2D array so out[r, c] = array[r + drow, c + dcol], filled outside the array.
+
+    Input
+    array(array): 2D array
+    drow(int): Row offset
+    dcol(int): Column offset
+    fill(float): Value for cells shifted in from outside
+
+    Output
+    out(array): Shifted array
+    """
+    rows, cols = array.shape
+    out = np.full_like(array, fill)
+    if abs(drow) >= rows or abs(dcol) >= cols:
+        return out
+    out[max(0, -drow):rows - max(0, drow), max(0, -dcol):cols - max(0, dcol)] = \
+        array[max(0, drow):rows - max(0, -drow), max(0, dcol):cols - max(0, -dcol)]
+    return out
+
+def shadow_mask(dsm, azimuth, elevation, scale, max_distance=None):
+    """
+    Sunlit mask of a DSM for one sun position by ray marching towards the sun.
+    A cell is shaded if any cell along the line to the sun rises above the sun ray
+    through it. Each step moves one pixel along the major axis of the sun direction
+    and the whole raster is tested at once.
+
+    Input
+    dsm(array): Heights in meters, nan where missing
+    azimuth(float): Sun azimuth in degrees clockwise from north
+    elevation(float): Sun elevation in degrees
+    scale(float): Pixel size in meters
+    max_distance(int): Longest shadow in pixels, None for no limit
+
+    Output
+    (array): 1 where sunlit, 0 where shaded (float32)
+    """
+    dsm = np.where(np.isnan(dsm), -np.inf, dsm).astype(np.float32)
+    dcol = np.sin(np.radians(azimuth))
+    drow = -np.cos(np.radians(azimuth))
+    step = 1 / max(abs(dcol), abs(drow))                                   # pixels travelled per step
+    rise = np.tan(np.radians(elevation)) * step * scale                    # sun ray rise per step in meters
+
+    # Stop once the sun ray has risen above the highest possible occluder
+    finite = dsm[np.isfinite(dsm)]
+    height_range = finite.max() - finite.min() if finite.size else 0
+    max_steps = int(min(np.ceil(height_range / rise), max(dsm.shape) / step + 1))
+    if max_distance is not None:
+        max_steps = min(max_steps, int(max_distance / step))
+
+    shaded = np.zeros(dsm.shape, dtype=bool)
+    for n in range(1, max_steps + 1):
+        occluder = shift(dsm, int(round(n * drow * step)), int(round(n * dcol * step)), -np.inf)
+        shaded |= occluder > dsm + n * rise
+
+    return (~shaded).astype(np.float32)
+
+def aggregate_shadows(dsm, scale, azimuth, elevation, weights=None, max_distance=None):
+    """
+    Weighted mean sunlit fraction of each DSM cell over a set of sun positions.
+
+    Input
+    dsm(array): Heights in meters, nan where missing
+    scale(float): Pixel size in meters
+    azimuth(array): Sun azimuths in degrees
+    elevation(array): Sun elevations in degrees
+    weights(array): Weight of each sun position, defaults to equal weights
+    max_distance(int): Longest shadow in pixels, None for no limit
+
+    Output
+    (array): Sunlit fraction 0-1 (float32)
+    """
+    print(f"Casting shadows for {len(azimuth)} sun positions...")
+    start = time.time()
+
+    if weights is None:
+        weights = np.ones(len(azimuth))
+
+    total = np.zeros(dsm.shape, dtype=np.float32)
+    for az, el, weight in zip(azimuth, elevation, weights):
+        total += np.float32(weight) * shadow_mask(dsm, az, el, scale, max_distance)
+
+    end = time.time()
+    print(f"Completed casting shadows in {end-start}s")
+
+    return total / np.float32(np.sum(weights))
+
+def shadow_halo(height_range, scale, min_elevation):
+    """
+    Pixels a shadow can reach for the lowest sun elevation, so a block padded by this
+    halo holds every occluder of its inner cells.
+
+    Input
+    height_range(float): Difference between highest and lowest DSM height in meters
+    scale(float): Pixel size in meters
+    min_elevation(float): Lowest sun elevation in degrees
+
+    Output
+    (int): Halo in pixels
+    """
+    return int(np.ceil(height_range / (np.tan(np.radians(min_elevation)) * scale))) + 1
+
+def blocks(rows, cols, block_size, halo):
+    """
+    Blocks covering a raster, each padded by a halo clipped to the raster bounds.
+
+    Input
+    rows(int): Raster rows
+    cols(int): Raster columns
+    block_size(int): Rows and columns of each block without halo
+    halo(int): Padding in pixels
+
+    Output
+    (generator): (row0, row1, col0, col1) of the padded block and (row slice, col slice) of the block inside it
+    """
+    for row in range(0, rows, block_size):
+        for col in range(0, cols, block_size):
+            row0, col0 = max(0, row - halo), max(0, col - halo)
+            row1, col1 = min(rows, row + block_size + halo), min(cols, col + block_size + halo)
+            inner = (slice(row - row0, min(rows, row + block_size) - row0),
+                     slice(col - col0, min(cols, col + block_size) - col0))
+            yield (row0, row1, col0, col1), inner
+
+def aggregate_shadows_windowed(read, write, shape, scale, height_range, azimuth, elevation, weights=None, block_size=1024, max_halo=None):
+    """
+    aggregate_shadows over overlapping blocks so memory is bounded by block size rather than tile size.
+    Each block is read with up to max_halo pixels of padding, and the padding is cut down to the shadow
+    halo of the lowest sun over the block's own height range (highest cell of the padded window above
+    the lowest cell of the block). The block is shaded on its own and written without the halo, which
+    gives the same result as the full tile since cells outside the tile are never occluders.
+
+    Shadows are capped at max_halo pixels, so a padded window is at most (block_size + 2 * max_halo)
+    pixels square, 9 times the block with the default max_halo = block_size. At 1m and 5 degrees of
+    elevation the default 1024px cap is only reached by occluders about 90m above the shaded cell.
+
+    Input
+    read(function): read(row0, row1, col0, col1) returns DSM heights of a window, nan where missing
+    write(function): write(row0, col0, array) stores sunlit fractions of a window
+    shape(tuple): Raster rows and columns
+    scale(float): Pixel size in meters
+    height_range(float): Difference between highest and lowest DSM height of the tile in meters
+    azimuth(array): Sun azimuths in degrees
+    elevation(array): Sun elevations in degrees
+    weights(array): Weight of each sun position, defaults to equal weights
+    block_size(int): Rows and columns of each block without halo
+    max_halo(int): Longest shadow in pixels, defaults to block_size
+    """
+    if max_halo is None:
+        max_halo = block_size
+    max_halo = min(max_halo, shadow_halo(height_range, scale, np.min(elevation))) if len(elevation) else 0
+    print(f"Casting shadows in {block_size}px blocks with at most a {max_halo}px halo...")
+    start = time.time()
+
+    for (row0, row1, col0, col1), inner in blocks(shape[0], shape[1], block_size, max_halo):
+        dsm = read(row0, row1, col0, col1)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)            # all-nan blocks
+            local_range = np.nanmax(dsm) - np.nanmin(dsm[inner])
+        halo = min(shadow_halo(local_range, scale, np.min(elevation)), max_halo) if np.isfinite(local_range) else 0
+
+        # Cut the padding down to this block's halo
+        r0, c0 = max(0, inner[0].start - halo), max(0, inner[1].start - halo)
+        r1, c1 = min(dsm.shape[0], inner[0].stop + halo), min(dsm.shape[1], inner[1].stop + halo)
+        fraction = aggregate_shadows(dsm[r0:r1, c0:c1], scale, azimuth, elevation, weights, max_halo)
+        write(row0 + inner[0].start, col0 + inner[1].start,
+              fraction[inner[0].start - r0:inner[0].stop - r0, inner[1].start - c0:inner[1].stop - c0])
+
+    end = time.time()
+    print(f"Completed casting shadows in blocks in {end-start}s")
@@ -4,36 +4,34 @@ from glob import glob
 import os
 import numpy as np
 
-def get_kk_factor(db, irradiance_df):
+def irradiance_table(irradiance_df):
     """
-    Map kk factor from MCS irradiance dataset based on aspect and slope
+    Convert MCS irradiance sheet to a dense kk factor array with slope and aspect lookups.
 
     Input
-    db(DataFrame): Roof segment information
     irradiance_df(DataFrame): 2x2 matrix of kk factor from aspect and slope
 
     Output
-    kk_factor(list): List of mapped kk factor
+    (dict): 'kk' array (slope x aspect), 'slope' and 'aspect' values of its rows and columns
+    
+    """
+    return {
+        'kk': irradiance_df.to_numpy(dtype=float),
+        'slope': np.asarray(irradiance_df.index, dtype=int),
+        'aspect': np.asarray(irradiance_df.columns, dtype=int)
+    }
 
+def read_irradiance_sheet(IRRADIANCE_PATH):
     """
-    kk_factor = []
-    for idx, row in db.iterrows():
-        aspect = abs(row['aspect_mean'] - np.pi) * 180 / np.pi
-        if 0 <=aspect <= 176 and 0 <= row['slope_mean'] < 90:
-            aspect = 5 * round(aspect/5) # round to nearest 5
-            slope = round(row['slope_mean'])
-            if 0<slope<=10:
-                kk_factor.append(irradiance_df.max().max())
-            else:
-                kk_factor.append(int(irradiance_df[aspect][slope]))
-        else:
-            kk_factor.append(0)
+    Read Zone 6 sheet of MCS irradiance dataset. 
 
-    return kk_factor
+    Input
+    IRRADIANCE_PATH(str): Path to Irradiance-Datasets.xlsx
 
-def main():
-    # Get irradiance data for mapping
-    IRRADIANCE_PATH = "..\\..\\data\\external\\Irradiance-Datasets.xlsx"
+    Output
+    irradiance_df(DataFrame): 2x2 matrix of kk factor from aspect and slope
+    
+    """
     irradiance_df = pd.read_excel(IRRADIANCE_PATH, sheet_name="Zone 6 - Birmingham", header=0)
     irradiance_df.columns = irradiance_df.loc[0].convert_dtypes()
     irradiance_df = irradiance_df.drop(0, axis=0)
@@ -41,6 +39,77 @@ def main():
     irradiance_df.index = irradiance_df.index.astype(int)
     irradiance_df = irradiance_df.iloc[: , 1:]
 
+    return irradiance_df
+
+def load_irradiance_table(IRRADIANCE_PATH):
+    """
+    Load kk factor table, caching the parsed sheet as .npz next to the workbook.
+    The cache is rebuilt when the workbook is newer than it.
+
+    Input
+    IRRADIANCE_PATH(str): Path to Irradiance-Datasets.xlsx
+
+    Output
+    (dict): Output of irradiance_table
+    
+    """
+    CACHE_PATH = os.path.splitext(IRRADIANCE_PATH)[0] + '.npz'
+
+    if os.path.isfile(CACHE_PATH) and os.path.getmtime(CACHE_PATH) >= os.path.getmtime(IRRADIANCE_PATH):
+        with np.load(CACHE_PATH) as cached:
+            return {key: cached[key] for key in ['kk', 'slope', 'aspect']}
+
+    table = irradiance_table(read_irradiance_sheet(IRRADIANCE_PATH))
+    np.savez(CACHE_PATH, **table)
+
+    return table
+
+def get_kk_factor(db, irradiance):
+    """
+    Map kk factor from MCS irradiance dataset based on aspect and slope
+
+    Input
+    db(DataFrame): Roof segment information
+    irradiance(dict or DataFrame): Output of irradiance_table, or 2x2 matrix of kk factor from aspect and slope
+
+    Output
+    kk_factor(array): Mapped kk factor
+
+    """
+    if isinstance(irradiance, pd.DataFrame):
+        irradiance = irradiance_table(irradiance)
+    kk = irradiance['kk']
+
+    # Positions of each slope and aspect value in the table, -1 where missing
+    slope_pos = np.full(irradiance['slope'].max() + 1, -1)
+    slope_pos[irradiance['slope']] = np.arange(len(irradiance['slope']))
+    aspect_pos = np.full(irradiance['aspect'].max() + 1, -1)
+    aspect_pos[irradiance['aspect']] = np.arange(len(irradiance['aspect']))
+
+    aspect = np.abs(db['aspect_mean'].to_numpy(dtype=float) - np.pi) * 180 / np.pi
+    slope = db['slope_mean'].to_numpy(dtype=float)
+    valid = (0 <= aspect) & (aspect <= 176) & (0 <= slope) & (slope < 90)
+
+    aspect = (5 * np.round(aspect[valid] / 5)).astype(int) # round to nearest 5
+    slope = np.round(slope[valid]).astype(int)
+    low_slope = (0 < slope) & (slope <= 10)
+
+    rows = np.where(slope < len(slope_pos), slope_pos[np.minimum(slope, len(slope_pos) - 1)], -1)
+    cols = np.where(aspect < len(aspect_pos), aspect_pos[np.minimum(aspect, len(aspect_pos) - 1)], -1)
+    missing = ~low_slope & ((rows < 0) | (cols < 0))
+    if missing.any():
+        raise KeyError(f"Slope/aspect not in irradiance dataset: {list(zip(slope[missing], aspect[missing]))[:5]}")
+
+    kk_factor = np.zeros(len(db))
+    kk_factor[valid] = np.where(low_slope, np.nanmax(kk), np.trunc(kk[rows, cols]))
+
+    return kk_factor
+
+def main():
+    # Get irradiance data for mapping
+    IRRADIANCE_PATH = "..\\..\\data\\external\\Irradiance-Datasets.xlsx"
+    irradiance = load_irradiance_table(IRRADIANCE_PATH)
+
     # Loop through roof segments in tiles
     FOLDER_DIR = '..\\01_calc_shadow\\output\\roof_segments_unfiltered\\'
     filesInFolder = glob(FOLDER_DIR + '*.geojson')
@@ -57,7 +126,7 @@ def main():
 
         # Calculate pv output of each roof segment based on MCS equation
         db['installed_capacity'] = db['AREA'] * 2.5
-        db['kk_factor'] = get_kk_factor(db, irradiance_df)
+        db['kk_factor'] = get_kk_factor(db, irradiance)
         db['pv_output'] = db['shading_mean'] * db['kk_factor'] * db['installed_capacity']
 
         # Group all roof segments to building
@@ -5,12 +5,16 @@ from pathlib import Path
 from glob import glob
 import time 
 import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import pvlib
 from pvlib.pvsystem import PVSystem, Array, FixedMount
 from pvlib.location import Location
 from pvlib.modelchain import ModelChain
 
+from weather_cache import WeatherCache
+
 # Set solar panel assumptions
 sandia_modules = pvlib.pvsystem.retrieve_sam('SandiaMod')
 sapm_inverters = pvlib.pvsystem.retrieve_sam('cecinverter')
@@ -18,9 +22,13 @@ module = sandia_modules['Canadian_Solar_CS5P_220M___2009_']
 inverter = sapm_inverters['ABB__MICRO_0_25_I_OUTD_US_208__208V_']
 temperature_model_parameters = pvlib.temperature.TEMPERATURE_MODEL_PARAMETERS['sapm']['open_rack_glass_glass']
 
+# Weather cache, set TMY_DIR to pre-downloaded PVGIS TMY csv files and offline=True to run without network
+weather_cache = WeatherCache(CACHE_DIR='weather_cache/', TMY_DIR=None, cell_size=0.05, offline=False)
+
 def get_weather(lat, lng):
     """
     Dataframe of hourly weather at coordinates for several years.
+    Served from the on-disk weather cache, see weather_cache.py.
 
     Inputs
     lat(float): Latitude of location
@@ -31,15 +39,7 @@ def get_weather(lat, lng):
     
     """
     print('Getting weather...')
-    start = time.time()
-
-    weather = pvlib.iotools.get_pvgis_tmy(lat, lng,
-                                        map_variables=True)[0]
-    weather.index.name = "utc_time"
-    
-    end = time.time()
-    print(f'Completed getting weather in {end-start}s')
-    return weather
+    return weather_cache.get(lat, lng)
 
 def calculate_PV(location, weather, slope, aspect):
     """
@@ -68,13 +68,118 @@ def calculate_PV(location, weather, slope, aspect):
 
     return annual_energy
 
-def avg_pv_output(location, weather):
+def solar_inputs(location, weather):
+    """
+    Solar position, airmass and extraterrestrial irradiance for the weather timestamps.
+    These only depend on location and time so are shared by every panel orientation.
+
+    Input
+    location(pvlib Location): Object with coordinates, altitude and timezone
+    weather(Dataframe): Hourly weather values for several years
+
+    Output
+    (dict): Hourly arrays with shape (1, hours) ready to broadcast against orientations
+    
+    """
+    kwargs = {}
+    if 'pressure' in weather:
+        kwargs['pressure'] = weather['pressure']
+    if 'temp_air' in weather:
+        kwargs['temperature'] = weather['temp_air']
+
+    solar_position = location.get_solarposition(weather.index, **kwargs)
+    airmass = location.get_airmass(solar_position=solar_position)
+    dni_extra = pvlib.irradiance.get_extra_radiation(weather.index)
+
+    inputs = {
+        'apparent_zenith': solar_position['apparent_zenith'],
+        'azimuth': solar_position['azimuth'],
+        'airmass_relative': airmass['airmass_relative'],
+        'airmass_absolute': airmass['airmass_absolute'],
+        'dni_extra': dni_extra,
+        'dni': weather['dni'],
+        'ghi': weather['ghi'],
+        'dhi': weather['dhi'],
+        'temp_air': weather.get('temp_air', 20),
+        'wind_speed': weather.get('wind_speed', 0),
+    }
+    return {key: np.broadcast_to(np.asarray(val, dtype=float), (len(weather),))[None, :] for key, val in inputs.items()}
+
+def sapm_spectral_modifier(airmass_absolute):
+    """
+    Spectral modifier of the solar pv module from absolute airmass, as applied by ModelChain.
+
+    Input
+    airmass_absolute(array): Absolute airmass
+
+    Output
+    (array): Spectral modifier (0 when airmass is undefined)
+    
+    """
+    coeff = [module['A4'], module['A3'], module['A2'], module['A1'], module['A0']]
+    modifier = np.polyval(coeff, airmass_absolute)
+    modifier = np.where(np.isnan(modifier), 0, modifier)
+    return np.maximum(0, modifier)
+
+def batched_pv_output(location, weather, slopes, aspects, chunk_size=256):
+    """
+    Estimate yearly solar panel output for many slope and aspect configurations at once.
+    Follows the same steps as calculate_PV (haydavies transposition, SAPM module and
+    temperature model, Sandia inverter) but evaluates all orientations as 2D arrays of
+    orientations x hours, computing solar position and airmass only once.
+
+    Inputs
+    location(pvlib Location): Object with coordinates, altitude and timezone
+    weather(Dataframe): Hourly weather values for several years
+    slopes(array): Angles in degrees the solar panels are tilted from horizontal
+    aspects(array): Azimuths (orientations) of the solar panels, same length as slopes
+    chunk_size(int): Number of orientations evaluated together, bounds memory use
+
+    Output
+    (array): Total solar panel output for a year in Whr/yr/m^2 for each orientation
+    
+    """
+    slopes, aspects = np.broadcast_arrays(np.asarray(slopes, dtype=float).ravel(), np.asarray(aspects, dtype=float).ravel())
+    inputs = solar_inputs(location, weather)
+    spectral_modifier = sapm_spectral_modifier(inputs['airmass_absolute'])
+    fd = module.get('FD', 1.)
+
+    energies = np.zeros(len(slopes))
+    for first in range(0, len(slopes), chunk_size):
+        tilt = slopes[first:first + chunk_size, None]
+        azimuth = aspects[first:first + chunk_size, None]
+
+        irradiance = pvlib.irradiance.get_total_irradiance(
+            tilt, azimuth,
+            inputs['apparent_zenith'], inputs['azimuth'],
+            inputs['dni'], inputs['ghi'], inputs['dhi'],
+            dni_extra=inputs['dni_extra'],
+            airmass=inputs['airmass_relative'],
+            model='haydavies'
+        )
+        aoi = pvlib.irradiance.aoi(tilt, azimuth, inputs['apparent_zenith'], inputs['azimuth'])
+        aoi_modifier = pvlib.iam.sapm(aoi, module)
+
+        effective_irradiance = spectral_modifier * (irradiance['poa_direct'] * aoi_modifier + fd * irradiance['poa_diffuse'])
+        cell_temperature = pvlib.temperature.sapm_cell(
+            irradiance['poa_global'], inputs['temp_air'], inputs['wind_speed'], **temperature_model_parameters
+        )
+        dc = pvlib.pvsystem.sapm(effective_irradiance, cell_temperature, module)
+        ac = pvlib.inverter.sandia(dc['v_mp'], dc['p_mp'], inverter)
+
+        energies[first:first + chunk_size] = np.nansum(ac, axis=1)
+
+    return energies
+
+def avg_pv_output(location, weather, slope_vals=np.arange(0, 61, 1), aspect_vals=np.arange(0, 175, 5)):
     """
     Average solar panel output over different potential aspect and slope configurations. 
 
     Input
     location(pvlib Location): Object with coordinates, altitude and timezone
     weather(Dataframe): Hourly weather values for several years
+    slope_vals(array): Slopes in degrees to average over
+    aspect_vals(array): Aspects in degrees to average over
 
     Output:
     (float): Average solar pv output over different possible solar panel setups in Whr/yr/m^2
@@ -83,51 +188,257 @@ def avg_pv_output(location, weather):
     print('Calculating solar output...')
     start = time.time()
 
-    slope_vals = np.arange(0, 61, 1)
-    aspect_vals = np.arange(0, 175, 5)
-
-    total_energy, counter = 0, 0
-    for slope in slope_vals:
-        for aspect in aspect_vals:
-            total_energy += calculate_PV(location, weather, slope, aspect)
-            counter += 1
-    avg_energy = total_energy/counter
+    slopes, aspects = np.meshgrid(slope_vals, aspect_vals, indexing='ij')
+    avg_energy = batched_pv_output(location, weather, slopes, aspects).mean()
 
     end = time.time()
-    print(f"Completed calculating PV output of {avg_energy} in {end-start}s")
+    print(f"Completed calculating PV output of {avg_energy} over {slopes.size} setups in {end-start}s")
 
     return avg_energy
 
-def roof_segment_output(db, weather, timezone='Etc/GMT+1'):
+def altitude_bands(height, altitude_band):
     """
-    Estimated yearly solar panel output for each roof segment given its slope and aspect.
+    Centre of the altitude band each height falls into.
 
     Input
-    db(DataFrame): Roof segment features
+    height(array): Heights in meters
+    altitude_band(float): Width of altitude bands in meters
+
+    Output
+    (array): Band centres in meters
+    
+    """
+    return np.floor(np.asarray(height, dtype=float) / altitude_band) * altitude_band + altitude_band / 2
+
+def tile_height(height):
+    """
+    Height used for roof segments without one, the median of the known heights of the tile.
+
+    Input
+    height(array): Heights in meters, nan where missing
+
+    Output
+    (float): Median height in meters, 0 if no height is known
+    
+    """
+    height = np.asarray(height, dtype=float)
+    height = height[~np.isnan(height)]
+    return float(np.median(height)) if height.size else 0.0
+
+def grid_axis(values, nodes):
+    """
+    Evenly spaced interpolation nodes covering the range of the values.
+
+    Input
+    values(array): Values the axis has to cover
+    nodes(int): Number of nodes on the axis
+
+    Output
+    (array): Sorted node values
+    
+    """
+    lo, hi = np.nanmin(values), np.nanmax(values)
+    if hi <= lo:
+        hi = lo + 1
+    return np.linspace(lo, hi, max(nodes, 2))
+
+def build_yield_grid(db, weather, timezone='Etc/GMT+1', slope_nodes=13, aspect_nodes=19, altitude_band=50):
+    """
+    Precompute yearly solar panel output on a (altitude band, slope, aspect) grid for one weather file.
+    Slope and aspect nodes span the range found in the roof segments, altitude bands are
+    centred on multiples of altitude_band. Location is the mean of the tile.
+
+    Input
+    db(DataFrame): Roof segment features with lat, lng, slope_mean, aspect_mean and height_mean
     weather(Dataframe): Hourly weather values for several years
     timezone(str)
+    slope_nodes(int): Number of slope nodes
+    aspect_nodes(int): Number of aspect nodes
+    altitude_band(float): Width of altitude bands in meters
 
     Output
-    energies(list): Solar pv output estimates for roof segments
+    grid(dict): Axes ('slope', 'aspect', 'altitude'), 'energy' array of shape (altitude, slope, aspect) in Whr/yr/m^2
+                and 'fallback_height' used by lookup_yield for segments without a height
     
     """
-    print('Calculating roof segment solar output...')
+    print('Building PV yield grid...')
     start = time.time()
 
+    latitude = db['lat'].mean()
+    longitude = db['lng'].mean()
+
+    slope_vals = grid_axis(db['slope_mean'], slope_nodes)
+    aspect_vals = grid_axis(db['aspect_mean'], aspect_nodes)
+    # Missing heights are looked up at the tile median, so they need no band of their own
+    fallback_height = tile_height(db['height_mean'])
+    heights = db['height_mean'].dropna()
+    altitude_vals = np.unique(altitude_bands(heights if len(heights) else [fallback_height], altitude_band))
+
+    slopes, aspects = np.meshgrid(slope_vals, aspect_vals, indexing='ij')
+    energy = np.zeros((len(altitude_vals), len(slope_vals), len(aspect_vals)))
+    for i, altitude in enumerate(altitude_vals):
+        location = Location(
+            latitude,
+            longitude,
+            name='',
+            altitude=altitude,
+            tz=timezone
+        )
+        energy[i] = batched_pv_output(location, weather, slopes, aspects).reshape(slopes.shape)
+
+    end = time.time()
+    print(f"Completed building PV yield grid of {energy.size} points in {end-start}s")
+
+    return {
+        'slope': slope_vals,
+        'aspect': aspect_vals,
+        'altitude': altitude_vals,
+        'altitude_band': altitude_band,
+        'fallback_height': fallback_height,
+        'energy': energy
+    }
+
+def interpolation_weights(axis, values):
+    """
+    Lower node index and fractional distance to the next node for linear interpolation.
+    Values outside the axis are clamped to the end nodes.
+
+    Input
+    axis(array): Sorted node values
+    values(array): Values to locate on the axis
+
+    Output
+    idx(array): Index of lower node
+    frac(array): Weight of upper node (0-1)
+    
+    """
+    values = np.asarray(values, dtype=float)
+    idx = np.clip(np.searchsorted(axis, values, side='right') - 1, 0, len(axis) - 2)
+    frac = (values - axis[idx]) / (axis[idx + 1] - axis[idx])
+    return idx, np.clip(frac, 0, 1)
+
+def lookup_yield(grid, slope, aspect, height):
+    """
+    Bilinear interpolation of yearly solar panel output in slope and aspect within the nearest altitude band.
+
+    Input
+    grid(dict): Output of build_yield_grid
+    slope(array): Roof segment slopes
+    aspect(array): Roof segment aspects
+    height(array): Roof segment heights in meters, nan where missing
+
+    Output
+    (array): Solar pv output estimates in Whr/yr/m^2
+    
+    """
+    energy = grid['energy']
+    height = np.asarray(height, dtype=float)
+    height = np.where(np.isnan(height), grid['fallback_height'], height)
+    bands = altitude_bands(height, grid['altitude_band'])
+    a = np.abs(bands[:, None] - grid['altitude'][None, :]).argmin(axis=1)
+    i, u = interpolation_weights(grid['slope'], slope)
+    j, v = interpolation_weights(grid['aspect'], aspect)
+
+    return (
+        energy[a, i, j] * (1 - u) * (1 - v)
+        + energy[a, i + 1, j] * u * (1 - v)
+        + energy[a, i, j + 1] * (1 - u) * v
+        + energy[a, i + 1, j + 1] * u * v
+    )
+
+def exact_roof_segment_output(db, weather, timezone='Etc/GMT+1'):
+    """
+    Yearly solar panel output for each roof segment from a full ModelChain run per segment.
+
+    Input
+    db(DataFrame): Roof segment features
+    weather(Dataframe): Hourly weather values for several years
+    timezone(str)
+
+    Output
+    energies(list): Solar pv output estimates for roof segments
+    
+    """
     energies = []
+    fallback_height = tile_height(db['height_mean'])
     for index, row in db.iterrows():
         location = Location(
             row['lat'],
             row['lng'],
             name='',
-            altitude=row['height_mean'],
+            altitude=row['height_mean'] if pd.notna(row['height_mean']) else fallback_height,
             tz=timezone
         )
         annual_energy = calculate_PV(location, weather, row['slope_mean'], row['aspect_mean'])
         energies.append(annual_energy)
 
+    return energies
+
+def grid_interpolation_error(db, weather, grid, sample_size=50, timezone='Etc/GMT+1', random_state=123):
+    """
+    Compare yield grid lookup against the exact calculate_PV path on a sample of roof segments.
+    Use to pick the grid resolution (slope_nodes, aspect_nodes, altitude_band).
+
+    Input
+    db(DataFrame): Roof segment features
+    weather(Dataframe): Hourly weather values for several years
+    grid(dict): Output of build_yield_grid
+    sample_size(int): Number of roof segments to compare
+    timezone(str)
+    random_state(int): Seed for sampling
+
+    Output
+    errors(DataFrame): Exact and interpolated output with absolute and relative error for each sampled segment
+    
+    """
+    print('Comparing yield grid with exact PV output...')
+    sample = db.sample(n=min(sample_size, len(db)), random_state=random_state)
+
+    errors = pd.DataFrame(index=sample.index)
+    errors['exact'] = exact_roof_segment_output(sample, weather, timezone)
+    errors['interpolated'] = lookup_yield(grid, sample['slope_mean'], sample['aspect_mean'], sample['height_mean'])
+    errors['abs_error'] = (errors['interpolated'] - errors['exact']).abs()
+    errors['rel_error'] = errors['abs_error'] / errors['exact'].abs().replace(0, np.nan)
+
+    print(
+        f"Yield grid {grid['energy'].shape} error on {len(errors)} segments: "
+        f"mean abs {errors['abs_error'].mean():.2f} Whr/yr/m^2, "
+        f"mean rel {errors['rel_error'].mean():.4%}, max rel {errors['rel_error'].max():.4%}"
+    )
+
+    return errors
+
+def roof_segment_output(db, weather, timezone='Etc/GMT+1', use_grid=True, validate_sample=0, **grid_params):
+    """
+    Estimated yearly solar panel output for each roof segment given its slope and aspect.
+    By default output is interpolated from a yield grid computed once for the weather file,
+    set use_grid=False to run a full ModelChain for every roof segment.
+
+    Input
+    db(DataFrame): Roof segment features
+    weather(Dataframe): Hourly weather values for several years
+    timezone(str)
+    use_grid(bool): Interpolate from yield grid instead of running every segment
+    validate_sample(int): Number of segments to check against the exact path, 0 to skip
+    grid_params: Passed on to build_yield_grid
+
+    Output
+    energies(array): Solar pv output estimates for roof segments
+    
+    """
+    print('Calculating roof segment solar output...')
+    start = time.time()
+
+    if use_grid:
+        grid = build_yield_grid(db, weather, timezone, **grid_params)
+        energies = lookup_yield(grid, db['slope_mean'], db['aspect_mean'], db['height_mean'])
+        if validate_sample:
+            grid_interpolation_error(db, weather, grid, validate_sample, timezone)
+    else:
+        energies = np.array(exact_roof_segment_output(db, weather, timezone))
+
     end = time.time()
-    print(f"Completed calculating PV output of {annual_energy} in {end-start}s")
+    print(f"Completed calculating PV output for {len(energies)} roof segments in {end-start}s")
 
     return energies
 
@@ -223,24 +534,86 @@ def roof_segment(path):
 
     return db
 
-def main():
+def process_tile(func, path, output_path):
+    """
+    Run func on one tile and write the result to its partition.
+    Written to a temporary file first so an interrupted run never leaves a partial partition.
+
+    Input
+    func(function): pv_no_DSM or roof_segment
+    path(str): Path to tile vector layer
+    output_path(str): Path to tile partition (.pkl)
+
+    Output
+    (str): Path to tile partition
+    
+    """
+    db = func(path)
+    temp_path = output_path + '.tmp'
+    db.to_pickle(temp_path)
+    os.replace(temp_path, output_path)
+
+    return output_path
+
+def run_tiles(files, func, OUTPUT_DIR, workers=None):
+    """
+    Run func over tiles in a process pool, writing one partition per tile to OUTPUT_DIR.
+    Tiles with an existing partition are skipped so a rerun resumes where it stopped.
+
+    Input
+    files(list): Paths to tile vector layers
+    func(function): pv_no_DSM or roof_segment
+    OUTPUT_DIR(str): Folder for tile partitions
+    workers(int): Number of worker processes, defaults to number of cores
+
+    Output
+    (DataFrame): Results of all tiles concatenated
+    
+    """
+    print(f'Running {func.__name__} on {len(files)} tiles...')
+    start = time.time()
+
+    if not os.path.isdir(OUTPUT_DIR):
+        os.makedirs(OUTPUT_DIR)
+
+    outputs = {path: OUTPUT_DIR + Path(path).stem + '.pkl' for path in files}
+    todo = [path for path in files if not os.path.isfile(outputs[path])]
+    print(f'Skipping {len(files) - len(todo)} tiles already processed.')
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_tile, func, path, outputs[path]): path for path in todo}
+        for future in as_completed(futures):
+            future.result()
+            print(f'Completed tile {Path(futures[future]).stem}')
+
+    db = pd.concat([pd.read_pickle(outputs[path]) for path in sorted(files)])
+
+    end = time.time()
+    print(f'Completed {func.__name__} on {len(files)} tiles in {end-start}s')
+
+    return db
+
+def main(workers=None):
     # FOLDER_DIR = '../01_calc_shadow/output/roof_segments_unfiltered/'
     # filesInFolder = glob(FOLDER_DIR + '*.geojson')
 
-    # roof_segment_pv = pd.DataFrame()
-    # for path in filesInFolder:
-    #     roof_segment_pv = gpd.GeoDataFrame(pd.concat([roof_segment_pv, roof_segment(path)]))
-        
-    # roof_segment_pv.to_file("output/roof_segment_pv.geojson", driver="GeoJSON")
+    # roof_segment_pv = run_tiles(filesInFolder, roof_segment, 'output/roof_segment_pv/', workers)
+    # roof_segment_pv.to_csv("output/roof_segment_pv.csv")
 
     FOLDER_DIR = '../01_calc_shadow/output/no_DSM/'
     filesInFolder = glob(FOLDER_DIR + '*.geojson')
 
-    building_pv = pd.DataFrame()
-    for path in filesInFolder:
-        building_pv = gpd.GeoDataFrame(pd.concat([building_pv, pv_no_DSM(path)]))
+    building_pv = gpd.GeoDataFrame(run_tiles(filesInFolder, pv_no_DSM, 'output/building_pv/', workers))
 
     building_pv.to_file("output/building_pv.geojson", driver="GeoJSON")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers',
+                        action='store',
+                        type=int,
+                        default=None,
+                        help='number of worker processes, defaults to number of cores')
+    args = parser.parse_args()
+
+    main(workers=args.workers)
@@ -0,0 +1,121 @@
+import pandas as pd
+import numpy as np
+from pathlib import Path
+from glob import glob
+import time
+import os
+
+import pvlib
+
+class WeatherCache():
+    """
+    Typical meteorological year (TMY) weather for a coordinate, cached on disk by grid cell.
+
+    Coordinates are snapped to the centre of a cell_size x cell_size degree cell and each cell
+    is stored once as Parquet in CACHE_DIR. Cells are filled from pre-downloaded PVGIS TMY csv
+    files (import_tmy_files) or, unless offline, from the PVGIS API.
+    """
+    def __init__(self, CACHE_DIR='weather_cache/', TMY_DIR=None, cell_size=0.05, offline=False):
+        self.CACHE_DIR = CACHE_DIR
+        if not os.path.isdir(self.CACHE_DIR):
+            os.makedirs(self.CACHE_DIR)
+        self.cell_size = cell_size
+        self.offline = offline
+        self.stats = {'hits': 0, 'misses': 0, 'load_time': 0.0}
+
+        if TMY_DIR is not None:
+            self.import_tmy_files(TMY_DIR)
+
+    def snap(self, lat, lng):
+        """
+        Centre of the grid cell the coordinates fall into.
+
+        Input
+        lat(float): Latitude of location
+        lng(float): Longitude of location
+
+        Output
+        (tuple): Latitude and longitude of cell centre
+
+        """
+        cell_lat = (np.floor(lat / self.cell_size) + 0.5) * self.cell_size
+        cell_lng = (np.floor(lng / self.cell_size) + 0.5) * self.cell_size
+        return round(cell_lat, 6), round(cell_lng, 6)
+
+    def cache_path(self, lat, lng):
+        """
+        Path of the cached weather file for the cell containing the coordinates.
+
+        Input
+        lat(float): Latitude of location
+        lng(float): Longitude of location
+
+        Output
+        (str): Path to Parquet file
+
+        """
+        cell_lat, cell_lng = self.snap(lat, lng)
+        return self.CACHE_DIR + f"tmy_{self.cell_size}_{cell_lat:.6f}_{cell_lng:.6f}.parquet"
+
+    def write(self, path, weather):
+        "Write weather to the cache, via a temporary file so parallel runs never read half-written files"
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        weather.to_parquet(temp_path)
+        os.replace(temp_path, path)
+
+    def import_tmy_files(self, TMY_DIR):
+        """
+        Seed the cache from TMY csv files downloaded from PVGIS so runs work offline.
+        The coordinates are read from each file's header and snapped to a cell.
+
+        Input
+        TMY_DIR(str): Folder with PVGIS TMY csv files
+        """
+        print('Importing TMY files...')
+        start = time.time()
+
+        files = glob(str(Path(TMY_DIR) / '*.csv'))
+        for path in files:
+            weather, _, inputs, _ = pvlib.iotools.read_pvgis_tmy(path, pvgis_format='csv', map_variables=True)
+            weather.index.name = "utc_time"
+            self.write(self.cache_path(inputs['latitude'], inputs['longitude']), weather)
+
+        end = time.time()
+        print(f'Completed importing {len(files)} TMY files in {end-start}s')
+
+    def get(self, lat, lng):
+        """
+        Dataframe of hourly weather for the grid cell containing the coordinates.
+
+        Inputs
+        lat(float): Latitude of location
+        lng(float): Longitude of location
+
+        Output
+        (Dataframe): Hourly weather data at cell location.
+
+        """
+        start = time.time()
+        path = self.cache_path(lat, lng)
+
+        if os.path.isfile(path):
+            self.stats['hits'] += 1
+            weather = pd.read_parquet(path)
+            source = 'cache'
+        else:
+            self.stats['misses'] += 1
+            if self.offline:
+                raise FileNotFoundError(f'No cached weather for ({lat}, {lng}) at {path} and offline is set')
+            cell_lat, cell_lng = self.snap(lat, lng)
+            weather = pvlib.iotools.get_pvgis_tmy(cell_lat, cell_lng, map_variables=True)[0]
+            weather.index.name = "utc_time"
+            self.write(path, weather)
+            source = 'PVGIS'
+
+        end = time.time()
+        self.stats['load_time'] += end - start
+        print(
+            f"Loaded weather from {source} in {end-start}s "
+            f"(hits: {self.stats['hits']}, misses: {self.stats['misses']}, total load time: {self.stats['load_time']}s)"
+        )
+        return weather